@@ -1,11 +1,77 @@
 #!/usr/bin/python
 
 from  pylxcfs.lxcfs import LXCFuse
+import  pylxcfs.lxcfs as lxcfs
 import  pylxcfs.fuse as fuse
-import sys
+from pylxcfs.fdpool import fd_budget
+import argparse
 
 if __name__ == "__main__":
 
-    server = fuse.FUSE(LXCFuse(), sys.argv[1], allow_other=True,
-                   foreground=True,nothreads=True)
+    parser = argparse.ArgumentParser(description="FUSE proc for lxc containers")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="number of files rendered concurrently; "
+                             "1 serves every request from a single thread")
+    parser.add_argument("--cache-ttl", type=float, default=10,
+                        help="seconds a rendering of a file, or the "
+                             "cgroups of a pid, are served from the cache")
+    parser.add_argument("--cache-entries", type=int, default=65536,
+                        help="maximum number of cached renderings")
+    parser.add_argument("--cache-bytes", type=int, default=64 << 20,
+                        help="maximum size of cached renderings in bytes")
+    parser.add_argument("--cpuinfo-mhz-interval", type=int, default=300,
+                        help="seconds between refreshes of the cpu MHz "
+                             "fields of /proc/cpuinfo, 0 never refreshes them")
+    parser.add_argument("--cgroup-fds", type=int,
+                        help="maximum number of cgroup files kept open, "
+                             "at most and by default half the open files "
+                             "limit")
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-render recently read files in the background "
+                             "before their cache entry expires")
+    parser.add_argument("--cpu-quota", action="store_true",
+                        help="show containers with a CFS quota only as many "
+                             "CPUs as the quota amounts to")
+    parser.add_argument("--loadavg-interval", type=float, default=5,
+                        help="seconds between samples of the container "
+                             "loads, 0 shows the host /proc/loadavg")
+    parser.add_argument("--loadavg-max-tasks", type=int, default=4096,
+                        help="tasks per container looked at in a sample, "
+                             "larger containers are sampled")
+    parser.add_argument("--stats-socket", metavar="PATH",
+                        help="also serve statistics in the Prometheus text "
+                             "format over HTTP on this unix socket")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="append every operation to a binary trace, "
+                             "see python -m pylxcfs.replay")
+    parser.add_argument("--entry-timeout", type=float, default=60,
+                        help="seconds the kernel caches name lookups")
+    parser.add_argument("--attr-timeout", type=float, default=60,
+                        help="seconds the kernel caches file attributes")
+    parser.add_argument("--negative-timeout", type=float, default=0,
+                        help="seconds the kernel caches failed lookups")
+    parser.add_argument("mountpoint")
+    args = parser.parse_args()
 
+    lxcfs.cache.ttl = args.cache_ttl
+    lxcfs.resolver.ttl = args.cache_ttl
+    lxcfs.cache.max_entries = args.cache_entries
+    lxcfs.cache.max_bytes = args.cache_bytes
+    lxcfs.host_cpuinfo.mhz_interval = args.cpuinfo_mhz_interval
+    if args.cgroup_fds is not None:
+        lxcfs.cgroup_files.size = min(args.cgroup_fds, fd_budget())
+    lxcfs.refresher.enabled = args.refresh
+    lxcfs.cpu_quota = args.cpu_quota
+    lxcfs.load_sampler.interval = args.loadavg_interval
+    lxcfs.load_sampler.max_tasks = args.loadavg_max_tasks
+    if args.stats_socket:
+        lxcfs.stats.serve(args.stats_socket)
+    if args.trace:
+        lxcfs.recorder.open(args.trace)
+
+    server = fuse.FUSE(LXCFuse(threads=args.threads), args.mountpoint,
+                   raw_fi=True, allow_other=True,
+                   foreground=True, nothreads=args.threads <= 1,
+                   entry_timeout=args.entry_timeout,
+                   attr_timeout=args.attr_timeout,
+                   negative_timeout=args.negative_timeout)
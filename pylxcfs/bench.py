@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+"""
+    Benchmarks LXCFuse in-process against synthetic hosts, without a mount:
+
+        python -m pylxcfs.bench [--cpus 8,64,512] [--containers 10,500,5000]
+                                [--tasks 4] [--duration 1] [--cpu-quota]
+                                [--save FILE] [--compare FILE]
+
+    Every combination of CPUs, containers and tasks per container is
+    generated as a fixture tree (/proc and the cgroup v1 hierarchies) in a
+    temporary directory, served through pylxcfs.lxcfs.setup(). Callers are
+    the container tasks in round robin, so reads hit every container and
+    every cpuset mask. getattr is timed on its own, read as the open, read,
+    release sequence the kernel issues for a cat.
+
+    --compare exits with 1 if any ops/s dropped by more than --threshold
+    against results saved earlier with --save.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pylxcfs.fuse as fuse
+import pylxcfs.lxcfs as lxcfs
+
+
+CONTROLLERS = ("cpuset", "cpu,cpuacct", "memory", "devices", "freezer",
+               "blkio")
+
+MEMINFO = (("MemTotal", 65536000), ("MemFree", 32768000),
+           ("MemAvailable", 49152000), ("Buffers", 1024000),
+           ("Cached", 16384000), ("SwapCached", 0), ("Active", 20480000),
+           ("Inactive", 8192000), ("SwapTotal", 8388608),
+           ("SwapFree", 8388608), ("Dirty", 1024), ("Shmem", 65536),
+           ("Slab", 1048576))
+
+
+def write(path, content):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, "w") as fd:
+        fd.write(content)
+
+
+def write_pid(root, pid, cgroup, started, state="S"):
+    write("%s/proc/%d/cgroup" % (root, pid),
+          "".join("%d:%s:%s\n" % (i + 1, controller, cgroup)
+                  for i, controller in enumerate(CONTROLLERS)))
+    fields = [state, "1"] + ["0"] * 17 + [str(started)] + ["0"] * 32
+    write("%s/proc/%d/stat" % (root, pid),
+          "%d (task %d) %s\n" % (pid, pid, " ".join(fields)))
+
+
+def make_host(root, cpus, containers, tasks, cgroups=None):
+    """
+        Writes a host with the given number of CPUs and containers, each
+        running tasks processes, below root, and returns a pid of every
+        container. Containers are named /lxc/ct<n> unless cgroups lists
+        their names, and get 4 CPUs each, handed out round robin, so cpuset
+        masks are shared.
+    """
+
+    write("%s/proc/self/mountinfo" % root,
+          "".join("%d 20 0:%d / /sys/fs/cgroup/%s rw,nosuid - cgroup "
+                  "cgroup rw,%s\n" % (30 + i, 30 + i, controller, controller)
+                  for i, controller in enumerate(CONTROLLERS)))
+
+    write("%s/proc/cpuinfo" % root, "\n".join(
+        "processor\t: %d\nvendor_id\t: GenuineIntel\ncpu family\t: 6\n"
+        "model name\t: Synthetic CPU @ 2.40GHz\ncpu MHz\t\t: 2400.000\n"
+        "cache size\t: 30720 KB\nphysical id\t: %d\ncore id\t\t: %d\n"
+        "flags\t\t: fpu vme de pse tsc msr pae mce cx8 apic sep mtrr\n"
+        "bogomips\t: 4800.00\n" % (cpu, cpu / 32, cpu % 32)
+        for cpu in range(cpus)) + "\n")
+
+    write("%s/proc/meminfo" % root, "".join(
+        "%-15s %8d kB\n" % ("%s:" % key, value) for key, value in MEMINFO))
+
+    write("%s/proc/stat" % root,
+          "cpu  %s\n" % " ".join(["%d" % (cpus * 1000)] * 10) +
+          "".join("cpu%d %s\n" % (cpu, " ".join(["1000"] * 10))
+                  for cpu in range(cpus)) +
+          "intr 123456789\nctxt 987654321\nbtime 1500000000\n"
+          "processes %d\nprocs_running 2\nprocs_blocked 0\n"
+          "softirq 1234567\n" % (containers * tasks))
+
+    write("%s/proc/uptime" % root, "864000.00 %d.00\n" % (864000 * cpus))
+
+    write("%s/proc/diskstats" % root,
+          "   8       0 sda 4000 100 800000 3000 2000 50 400000 9000 0 "
+          "7000 12000\n"
+          "   8       1 sda1 3900 100 790000 2900 1900 50 390000 8900 0 "
+          "6900 11800\n"
+          "   8      16 sdb 100 0 8000 60 0 0 0 0 0 50 60\n")
+
+    write("%s/proc/loadavg" % root, "%d.00 %d.00 %d.00 %d/%d %d\n" % (
+        containers, containers, containers, containers,
+        containers * tasks, 99 + containers * tasks))
+
+    width = min(4, cpus)
+    callers = []
+    pid = 100
+    for n in range(containers):
+        cgroup = cgroups[n] if cgroups else "/lxc/ct%d" % n
+        first = n * width % cpus
+        cpuset = range(first, min(first + width, cpus))
+        mask = "%d-%d" % (cpuset[0], cpuset[-1])
+
+        pids = range(pid, pid + tasks)
+        pid += tasks
+        for i, task in enumerate(pids):
+            # one runnable task per container
+            write_pid(root, task, cgroup, 1000 * (n + 1) + i,
+                      "R" if i == 0 else "S")
+        callers.append(pids[-1])
+
+        base = "%s/sys/fs/cgroup" % root
+        write("%s/cpuset%s/cpuset.cpus" % (base, cgroup), "%s\n" % mask)
+        write("%s/cpuset%s/cgroup.procs" % (base, cgroup),
+              "".join("%d\n" % task for task in pids))
+        write("%s/cpuset%s/tasks" % (base, cgroup),
+              "".join("%d\n" % task for task in pids))
+        # every other container has a CFS quota of 2 CPUs
+        write("%s/cpu,cpuacct%s/cpu.cfs_quota_us" % (base, cgroup),
+              "%d\n" % (200000 if n % 2 else -1))
+        write("%s/cpu,cpuacct%s/cpu.cfs_period_us" % (base, cgroup),
+              "100000\n")
+        write("%s/cpu,cpuacct%s/cpuacct.usage_percpu" % (base, cgroup),
+              " ".join("%d" % (10 ** 9 if cpu in cpuset else 0)
+                       for cpu in range(cpus)) + " \n")
+        write("%s/cpu,cpuacct%s/cpuacct.stat" % (base, cgroup),
+              "user %d\nsystem %d\n" % (75 * len(cpuset), 25 * len(cpuset)))
+        # I/O on sda only
+        for key, read, written in (("io_service_bytes", 1 << 20, 1 << 19),
+                                   ("io_serviced", 16, 8)):
+            total = read + written
+            write("%s/blkio%s/blkio.throttle.%s" % (base, cgroup, key),
+                  "8:0 Read %d\n8:0 Write %d\n8:0 Sync %d\n8:0 Async 0\n"
+                  "8:0 Total %d\nTotal %d\n" % (read, written, total, total,
+                                                  total))
+        write("%s/memory%s/memory.limit_in_bytes" % (base, cgroup),
+              "%d\n" % (1 << 30))
+        write("%s/memory%s/memory.memsw.limit_in_bytes" % (base, cgroup),
+              "%d\n" % (2 << 30))
+        write("%s/memory%s/memory.usage_in_bytes" % (base, cgroup),
+              "%d\n" % (256 << 20))
+        write("%s/memory%s/memory.memsw.usage_in_bytes" % (base, cgroup),
+              "%d\n" % (300 << 20))
+        write("%s/memory%s/memory.stat" % (base, cgroup),
+              "cache %d\nrss %d\ntotal_cache %d\ntotal_rss %d\n" %
+              ((64 << 20,) * 4))
+
+    return callers
+
+
+def measure(op, duration):
+    """
+        Calls op() for duration seconds and returns the sorted latencies.
+    """
+
+    latencies = []
+    stop = time.time() + duration
+    while True:
+        start = time.time()
+        op()
+        end = time.time()
+        latencies.append(end - start)
+        if end >= stop:
+            break
+    latencies.sort()
+    return latencies
+
+
+def run(cpus, containers, tasks, duration):
+    """
+        Returns a list of result dicts for one synthetic host.
+    """
+
+    root = tempfile.mkdtemp(prefix="pylxcfs-bench-")
+    context = fuse.fuse_get_context
+    try:
+        callers = itertools.cycle(make_host(root, cpus, containers, tasks))
+        caller = [0]
+        fuse.fuse_get_context = lambda: (0, 0, caller[0])
+
+        operations = lxcfs.LXCFuse(root=root)
+
+        def getattr_op(path):
+            caller[0] = next(callers)
+            operations("getattr", path, None)
+
+        def read_op(path):
+            caller[0] = next(callers)
+            fi = fuse.fuse_file_info()
+            operations("open", path, fi)
+            offset = 0
+            while True:
+                buf = operations("read", path, 4096, offset, fi)
+                if not buf:
+                    break
+                offset += len(buf)
+            operations("release", path, fi)
+
+        results = []
+        for path in sorted(lxcfs.files):
+            for name, op in (("getattr", getattr_op), ("read", read_op)):
+                # One round over all containers fills the cache, as a
+                # running daemon would have.
+                for i in range(containers):
+                    op(path)
+
+                latencies = measure(lambda: op(path), duration)
+                results.append({
+                    "cpus": cpus, "containers": containers, "tasks": tasks,
+                    "op": name, "path": path,
+                    "ops": len(latencies) / sum(latencies),
+                    "p50": latencies[len(latencies) / 2],
+                    "p99": latencies[len(latencies) * 99 / 100],
+                    "max": latencies[-1]})
+        return results
+    finally:
+        fuse.fuse_get_context = context
+        lxcfs.setup()
+        shutil.rmtree(root)
+
+
+def key(result):
+    return "%(cpus)d/%(containers)d/%(tasks)d %(op)s %(path)s" % result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmark pylxcfs against synthetic hosts")
+    parser.add_argument("--cpus", default="8,64,512",
+                        help="comma separated CPU counts")
+    parser.add_argument("--containers", default="10,500,5000",
+                        help="comma separated container counts")
+    parser.add_argument("--tasks", default="4",
+                        help="comma separated task counts per container")
+    parser.add_argument("--duration", type=float, default=1,
+                        help="seconds each file and operation is timed")
+    parser.add_argument("--cpu-quota", action="store_true",
+                        help="trim the CPU views to the CFS quota")
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare ops/s with results saved earlier")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative ops/s drop --compare fails on")
+    args = parser.parse_args()
+    lxcfs.cpu_quota = args.cpu_quota
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r") as fd:
+            baseline = dict((key(result), result) for result in json.load(fd))
+
+    print "%-16s %-8s %-14s %12s %10s %10s %10s %8s" % (
+        "cpus/cts/tasks", "op", "path", "ops/s", "p50_us", "p99_us",
+        "max_us", "change")
+
+    results = []
+    regressed = False
+    for cpus, containers, tasks in itertools.product(
+            *[[int(n) for n in value.split(",")]
+              for value in (args.cpus, args.containers, args.tasks)]):
+        for result in run(cpus, containers, tasks, args.duration):
+            change = ""
+            old = baseline.get(key(result))
+            if old is not None:
+                ratio = result["ops"] / old["ops"] - 1
+                change = "%+.0f%%" % (ratio * 100)
+                if ratio < -args.threshold:
+                    change += " !"
+                    regressed = True
+
+            print "%-16s %-8s %-14s %12.0f %10.0f %10.0f %10.0f %8s" % (
+                "%d/%d/%d" % (cpus, containers, tasks), result["op"],
+                result["path"], result["ops"], result["p50"] * 1e6,
+                result["p99"] * 1e6, result["max"] * 1e6, change)
+            sys.stdout.flush()
+            results.append(result)
+
+    if args.save:
+        with open(args.save, "w") as fd:
+            json.dump(results, fd, indent=1)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
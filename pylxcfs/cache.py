@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+import collections
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+
+class CacheEntry(object):
+    __slots__ = ('key', 'content', 'size', 'expires', 'used')
+
+    def __init__(self, key, content, size, expires, used):
+        self.key = key
+        self.content = content
+        self.size = size
+        self.expires = expires
+        self.used = used
+
+
+class Flight(object):
+    __slots__ = ('done', 'content', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.content = None
+        self.error = None
+
+
+class ProcCache(object):
+    '''
+    Cache of rendered content keyed by (cgroup, entry).
+
+    An entry is up to date for `ttl` seconds after its last update and is
+    dropped once nobody looked it up for `retention` seconds. Retention
+    deadlines live in a heap, so a purge only touches the entries that are
+    actually due. On top of that the cache holds at most `max_entries`
+    entries and `max_bytes` bytes of content, evicting the least recently
+    used entries first.
+
+    All public methods are serialized by a lock, so a single instance may be
+    shared by the FUSE worker threads. fetch() additionally coalesces
+    concurrent misses of one entry into a single render.
+
+    The public counters (hits, misses, ...) are only ever incremented, and
+    if set, on_render(entry, seconds) is called after every fetch() render.
+    '''
+
+    def __init__(self, ttl=10, retention=60, max_entries=65536,
+                 max_bytes=64 << 20):
+        self.ttl = ttl
+        self.retention = retention
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Insertion order is LRU order, lookups move an entry to the end.
+        self.__entries = collections.OrderedDict()
+        # (retention deadline, seq, entry); stale items are skipped lazily.
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+        # (cgroup, entry) -> Flight of the render in progress
+        self.__flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.on_render = None
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def nbytes(self):
+        return self.__bytes
+
+    def lookup(self, cgroup, entry):
+        """
+            Returns the cached content, or None if there is no up to date
+            entry.
+        """
+
+        now = time.time()
+        with self.__lock:
+            e = self.__entries.pop((cgroup, entry), None)
+            if e is None:
+                self.misses += 1
+                return None
+            self.__entries[e.key] = e
+            e.used = now
+            if e.expires <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return e.content
+
+    def fetch(self, cgroup, entry, render):
+        """
+            Returns the cached content, calling render() on a miss; render
+            is expected to update() the entry and return the content. The
+            first caller missing an entry renders it, callers missing it
+            meanwhile wait for that render and share its result (or error).
+        """
+
+        content = self.lookup(cgroup, entry)
+        if content is not None:
+            return content
+
+        key = (cgroup, entry)
+        with self.__lock:
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.content
+
+        start = time.time()
+        try:
+            flight.content = render()
+            if self.on_render is not None:
+                self.on_render(entry, time.time() - start)
+            return flight.content
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.done.set()
+
+    def update(self, cgroup, entry, content, ttl=None):
+        """
+            Stores content, valid for ttl seconds (the cache default if
+            None), and returns it.
+        """
+
+        now = time.time()
+        key = (cgroup, entry)
+        e = CacheEntry(key, content, sys.getsizeof(content),
+                       now + (self.ttl if ttl is None else ttl), now)
+
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__bytes -= old.size
+            self.__entries[key] = e
+            self.__bytes += e.size
+            heapq.heappush(self.__heap,
+                           (now + self.retention, next(self.__seq), e))
+
+            self.__purge(now)
+        return content
+
+    def invalidate(self, cgroup, entry):
+        with self.__lock:
+            e = self.__entries.get((cgroup, entry))
+            if e is not None:
+                self.__drop(e)
+
+    def __drop(self, e):
+        del self.__entries[e.key]
+        self.__bytes -= e.size
+
+    def __purge(self, now):
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            deadline, seq, e = heapq.heappop(heap)
+            if self.__entries.get(e.key) is not e:
+                continue
+            if e.used + self.retention > now:
+                heapq.heappush(heap, (e.used + self.retention, seq, e))
+            else:
+                self.__drop(e)
+                self.expirations += 1
+
+        while self.__entries and (len(self.__entries) > self.max_entries or
+                                  self.__bytes > self.max_bytes):
+            key, e = self.__entries.popitem(last=False)
+            self.__bytes -= e.size
+            self.evictions += 1
+
+        # Replaced and evicted entries leave their heap items behind, rebuild
+        # the heap before they outnumber the live ones.
+        if len(heap) > 2 * len(self.__entries) + 64:
+            self.__heap = [item for item in heap
+                           if self.__entries.get(item[2].key) is item[2]]
+            heapq.heapify(self.__heap)
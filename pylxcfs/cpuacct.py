@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+import array
+import collections
+import threading
+
+
+class CpuacctView(object):
+    '''
+    The per CPU user, system and idle ticks last shown to a cgroup, and the
+    raw values they were derived from.
+    '''
+
+    __slots__ = ('mask', 'usage', 'host', 'stat', 'share',
+                 'user', 'system', 'idle')
+
+    def __init__(self, mask, usage, stat, host, previous=None):
+        self.mask = mask
+        self.share = _share(stat[0], stat[1], 0.5)
+        self.user = array.array('d', [u * self.share for u in usage])
+        self.system = array.array('d', [u - x
+                                        for u, x in zip(usage, self.user)])
+        self.idle = array.array('d', [max(h - u, 0)
+                                      for h, u in zip(host, usage)])
+        self.usage, self.stat, self.host = usage, stat, host
+        if previous is not None:
+            self.carry(previous)
+
+    def carry(self, previous):
+        """
+            Continues the CPUs this view shares with the view of another
+            mask of the cgroup from what that one showed, instead of
+            splitting their raw counters anew.
+        """
+
+        share = _share(self.stat[0] - previous.stat[0],
+                       self.stat[1] - previous.stat[1], previous.share)
+        index = dict((cpu, j) for j, cpu in enumerate(previous.mask))
+        for i, cpu in enumerate(self.mask):
+            j = index.get(cpu)
+            if j is None:
+                continue
+            used = max(self.usage[i] - previous.usage[j], 0)
+            elapsed = max(self.host[i] - previous.host[j], 0)
+            self.user[i] = previous.user[j] + used * share
+            self.system[i] = previous.system[j] + used * (1 - share)
+            self.idle[i] = previous.idle[j] + max(elapsed - used, 0)
+        self.share = share
+
+    def advance(self, usage, stat, host):
+        # The user/system split of cpuacct.stat isn't per CPU, the time
+        # used on a CPU since the last read is split by its overall ratio.
+        self.share = _share(stat[0] - self.stat[0], stat[1] - self.stat[1],
+                            self.share)
+        share = self.share
+        used = [max(n - o, 0) for n, o in zip(usage, self.usage)]
+        elapsed = [max(n - o, 0) for n, o in zip(host, self.host)]
+
+        self.user = array.array('d', [t + u * share
+                                      for t, u in zip(self.user, used)])
+        self.system = array.array('d', [t + u * (1 - share)
+                                        for t, u in zip(self.system, used)])
+        self.idle = array.array('d', [t + max(e - u, 0)
+                                      for t, e, u in zip(self.idle, elapsed,
+                                                         used)])
+        self.usage, self.stat, self.host = usage, stat, host
+
+
+def _share(user, system, default):
+    if user < 0 or system < 0 or user + system == 0:
+        return default
+    return float(user) / (user + system)
+
+
+class CpuacctStore:
+    '''
+    Per cgroup CPU times for /proc/stat, derived from cpuacct and kept
+    monotonic across reads: only the growth of the raw counters since the
+    previous read is added to what the cgroup was shown, so a recreated
+    cgroup, rounding or a shifting user/system ratio never make a counter
+    go backwards. Idle time is the time that passed on the host CPU minus
+    the time the cgroup used it.
+
+    Views are kept per cgroup and CPU mask, as callers of one cgroup may
+    see different CPUs, for the `size` most recently read ones. The first
+    view of a new mask, e.g. after a cpuset edit, continues the CPUs it
+    shares with the mask last read.
+    '''
+
+    def __init__(self, size=16384):
+        self.__size = size
+        # (cgroup, mask) -> CpuacctView
+        self.__views = collections.OrderedDict()
+        # cgroup -> mask last read
+        self.__latest = {}
+        self.__lock = threading.Lock()
+
+    def update(self, cgroup, mask, usage, stat, host):
+        """
+            Takes the CPUs of a cgroup with the ticks it used (cpuacct) and
+            the ticks that passed (host) on each of them, and the user and
+            system ticks of its cpuacct.stat; returns per CPU lists of user,
+            system and idle ticks.
+        """
+
+        with self.__lock:
+            view = self.__views.pop((cgroup, mask), None)
+            if view is None:
+                previous = self.__views.get((cgroup,
+                                             self.__latest.get(cgroup)))
+                view = CpuacctView(mask, usage, stat, host, previous)
+            else:
+                view.advance(usage, stat, host)
+
+            self.__views[(cgroup, mask)] = view
+            self.__latest[cgroup] = mask
+            while len(self.__views) > self.__size:
+                evicted, evicted_mask = self.__views.popitem(last=False)[0]
+                if self.__latest.get(evicted) == evicted_mask:
+                    del self.__latest[evicted]
+            return view.user, view.system, view.idle
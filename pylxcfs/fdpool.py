@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import resource
+import sys
+import threading
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                        ctypes.c_longlong]
+_libc.pread.restype = ctypes.c_ssize_t
+
+
+def fd_budget():
+    """
+        Returns how many descriptors a FilePool may keep: half the soft
+        RLIMIT_NOFILE, the other half is left to everything else the daemon
+        opens (/proc files, inotify, /dev/fuse).
+    """
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = hard if hard != resource.RLIM_INFINITY else 1 << 20
+    return max(soft / 2, 1)
+
+
+class FilePool:
+    '''
+    Keeps hot cgroup control files open and re-reads them with pread(2)
+    from offset 0 into a reusable buffer, which replaces open/read/close by
+    preads up to EOF, usually two. At most `size` descriptors are kept, the
+    least recently read one is closed first. The default size is
+    fd_budget(), and when the process runs out of descriptors anyway
+    (EMFILE, ENFILE) the least recently read half of the pool is closed
+    and the open retried.
+
+    Reading a file of a removed cgroup fails (ENODEV); the stale descriptor
+    is closed and the file opened again, so a cgroup recreated under the
+    same name is picked up and a gone one fails like a fresh open would.
+    '''
+
+    def __init__(self, size=None, bufsize=16 * 1024):
+        self.size = fd_budget() if size is None else size
+        self.__fds = collections.OrderedDict()
+        self.__buf = ctypes.create_string_buffer(bufsize)
+        # Also held during pread(), an evicted descriptor number must not
+        # be reused under a concurrent reader.
+        self.__lock = threading.Lock()
+
+    def read(self, path):
+        with self.__lock:
+            fd = self.__fds.pop(path, None)
+            if fd is not None:
+                try:
+                    value = self.__pread(fd, path)
+                    self.__fds[path] = fd
+                    return value
+                except (IOError, OSError):
+                    os.close(fd)
+
+            fd = self.__open(path)
+            try:
+                value = self.__pread(fd, path)
+            except:
+                os.close(fd)
+                raise
+
+            self.__fds[path] = fd
+            while len(self.__fds) > self.size:
+                os.close(self.__fds.popitem(last=False)[1])
+            return value
+
+    def __open(self, path):
+        while True:
+            try:
+                return os.open(path, os.O_RDONLY)
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE) or \
+                   not self.__fds:
+                    raise
+            for i in range((len(self.__fds) + 1) / 2):
+                os.close(self.__fds.popitem(last=False)[1])
+
+    def close(self):
+        with self.__lock:
+            while self.__fds:
+                os.close(self.__fds.popitem()[1])
+
+    def __pread(self, fd, path):
+        # cgroup and proc files are seq_files, a single read returns at most
+        # about a page of them: keep reading until EOF.
+        buf = self.__buf
+        size = 0
+        while True:
+            if size == len(buf):
+                self.__buf = ctypes.create_string_buffer(2 * len(buf))
+                ctypes.memmove(self.__buf, buf, size)
+                buf = self.__buf
+            n = _libc.pread(fd, ctypes.byref(buf, size), len(buf) - size,
+                            size)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise IOError(err, os.strerror(err), path)
+            if n == 0:
+                return ctypes.string_at(buf, size)
+            size += n
+
+
+def check(paths):
+    """
+        Reads every path through a FilePool, twice so the kept descriptor
+        is re-read too, and returns the paths whose content differs from a
+        plain read. The pool starts with a buffer of a single page, so
+        files larger than that exercise the short reads of seq_files and
+        the buffer growth.
+    """
+
+    pool = FilePool(bufsize=4096)
+    failed = []
+    try:
+        for path in paths:
+            with open(path, "r") as fd:
+                expected = fd.read()
+            if pool.read(path) != expected or pool.read(path) != expected:
+                failed.append(path)
+    finally:
+        pool.close()
+    return failed
+
+
+if __name__ == "__main__":
+    # python -m pylxcfs.fdpool [PATH ...]: paths must not change between
+    # reads, /proc/kallsyms is a static seq_file of several megabytes.
+    failed = check(sys.argv[1:] or ["/proc/kallsyms"])
+    for path in failed:
+        print >> sys.stderr, "%s: pooled read differs" % path
+    sys.exit(1 if failed else 0)
@@ -26,21 +26,6 @@ from traceback import print_exc
 
 import logging
 
-try:
-    from functools import partial
-except ImportError:
-    # http://docs.python.org/library/functools.html#functools.partial
-    def partial(func, *args, **keywords):
-        def newfunc(*fargs, **fkeywords):
-            newkeywords = keywords.copy()
-            newkeywords.update(fkeywords)
-            return func(*(args + fargs), **newkeywords)
-
-        newfunc.func = func
-        newfunc.args = args
-        newfunc.keywords = keywords
-        return newfunc
-
 try:
     basestring
 except NameError:
@@ -335,6 +320,51 @@ def fuse_get_context():
     return ctx.uid, ctx.gid, ctx.pid
 
 
+class Snapshot(object):
+    '''
+    File content that read() serves without copying it in Python: an
+    Operations.read() may return snapshot.slice(offset, size) instead of a
+    string, FUSE then copies the slice straight from the snapshot into the
+    kernel buffer. The content must be a byte string.
+    '''
+
+    __slots__ = ('data', 'address')
+
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            raise TypeError('snapshot content must be bytes')
+        # A c_char_p of a str points into the str itself, which never moves
+        # and is kept alive by self.data.
+        self.data = data
+        self.address = cast(c_char_p(data), c_void_p).value
+
+    def __len__(self):
+        return len(self.data)
+
+    def slice(self, offset, size):
+        size = max(min(size, len(self.data) - offset), 0)
+        return SnapshotSlice(self, self.address + offset, size)
+
+
+class SnapshotSlice(object):
+    __slots__ = ('snapshot', 'address', 'size')
+
+    def __init__(self, snapshot, address, size):
+        # keeps the snapshot, and so the address, alive
+        self.snapshot = snapshot
+        self.address = address
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return string_at(self.address, self.size)
+
+    def __repr__(self):
+        return '<SnapshotSlice of %d bytes>' % self.size
+
+
 class FuseOSError(OSError):
     def __init__(self, errno):
         super(FuseOSError, self).__init__(errno, strerror(errno))
@@ -367,6 +397,7 @@ class FUSE(object):
         self.operations = operations
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self._paths = {}
 
         args = ['fuse']
 
@@ -384,7 +415,7 @@ class FUSE(object):
         fuse_ops = fuse_operations()
         for name, prototype in fuse_operations._fields_:
             if prototype != c_voidp and getattr(operations, name, None):
-                op = partial(self._wrapper, getattr(self, name))
+                op = self._wrapper(getattr(self, name))
                 setattr(fuse_ops, name, prototype(op))
 
         try:
@@ -413,22 +444,37 @@ class FUSE(object):
                 yield '%s=%s' % (key, value)
 
     @staticmethod
-    def _wrapper(func, *args, **kwargs):
+    def _wrapper(func):
         'Decorator for the methods that follow'
 
+        def wrapper(*args):
+            try:
+                return func(*args) or 0
+            except OSError, e:
+                return -(e.errno or EFAULT)
+            except:
+                print_exc()
+                return -EFAULT
+
+        return wrapper
+
+    def _decode(self, path):
+        'Decodes a path; the same few paths are looked up over and over'
+
         try:
-            return func(*args, **kwargs) or 0
-        except OSError, e:
-            return -(e.errno or EFAULT)
-        except:
-            print_exc()
-            return -EFAULT
+            return self._paths[path]
+        except KeyError:
+            # bound the cache, any path can be looked up
+            if len(self._paths) >= 4096:
+                self._paths.clear()
+            decoded = self._paths[path] = path.decode(self.encoding)
+            return decoded
 
     def getattr(self, path, buf):
         return self.fgetattr(path, buf, None)
 
     def readlink(self, path, buf, bufsize):
-        ret = self.operations('readlink', path.decode(self.encoding)) \
+        ret = self.operations('readlink', self._decode(path)) \
                   .encode(self.encoding)
 
         # copies a string into the given buffer
@@ -438,16 +484,16 @@ class FUSE(object):
         return 0
 
     def mknod(self, path, mode, dev):
-        return self.operations('mknod', path.decode(self.encoding), mode, dev)
+        return self.operations('mknod', self._decode(path), mode, dev)
 
     def mkdir(self, path, mode):
-        return self.operations('mkdir', path.decode(self.encoding), mode)
+        return self.operations('mkdir', self._decode(path), mode)
 
     def unlink(self, path):
-        return self.operations('unlink', path.decode(self.encoding))
+        return self.operations('unlink', self._decode(path))
 
     def rmdir(self, path):
-        return self.operations('rmdir', path.decode(self.encoding))
+        return self.operations('rmdir', self._decode(path))
 
     def symlink(self, source, target):
         'creates a symlink `target -> source` (e.g. ln -s source target)'
@@ -466,7 +512,7 @@ class FUSE(object):
                                        source.decode(self.encoding))
 
     def chmod(self, path, mode):
-        return self.operations('chmod', path.decode(self.encoding), mode)
+        return self.operations('chmod', self._decode(path), mode)
 
     def chown(self, path, uid, gid):
         # Check if any of the arguments is a -1 that has overflowed
@@ -475,17 +521,17 @@ class FUSE(object):
         if c_gid_t(gid + 1).value == 0:
             gid = -1
 
-        return self.operations('chown', path.decode(self.encoding), uid, gid)
+        return self.operations('chown', self._decode(path), uid, gid)
 
     def truncate(self, path, length):
-        return self.operations('truncate', path.decode(self.encoding), length)
+        return self.operations('truncate', self._decode(path), length)
 
     def open(self, path, fip):
         fi = fip.contents
         if self.raw_fi:
-            return self.operations('open', path.decode(self.encoding), fi)
+            return self.operations('open', self._decode(path), fi)
         else:
-            fi.fh = self.operations('open', path.decode(self.encoding),
+            fi.fh = self.operations('open', self._decode(path),
                                             fi.flags)
 
             return 0
@@ -496,7 +542,7 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        ret = self.operations('read', path.decode(self.encoding), size,
+        ret = self.operations('read', self._decode(path), size,
                                       offset, fh)
 
         if not ret: return 0
@@ -505,8 +551,10 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
-        memmove(buf, ret, retsize)
+        if isinstance(ret, SnapshotSlice):
+            memmove(buf, ret.address, retsize)
+        else:
+            memmove(buf, ret, retsize)
         return retsize
 
     def write(self, path, buf, size, offset, fip):
@@ -517,12 +565,12 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('write', path.decode(self.encoding), data,
+        return self.operations('write', self._decode(path), data,
                                         offset, fh)
 
     def statfs(self, path, buf):
         stv = buf.contents
-        attrs = self.operations('statfs', path.decode(self.encoding))
+        attrs = self.operations('statfs', self._decode(path))
         for key, val in attrs.items():
             if hasattr(stv, key):
                 setattr(stv, key, val)
@@ -535,7 +583,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('flush', path.decode(self.encoding), fh)
+        return self.operations('flush', self._decode(path), fh)
 
     def release(self, path, fip):
         if self.raw_fi:
@@ -543,7 +591,7 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
-        return self.operations('release', path.decode(self.encoding), fh)
+        return self.operations('release', self._decode(path), fh)
 
     def fsync(self, path, datasync, fip):
         if self.raw_fi:
@@ -551,16 +599,16 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('fsync', path.decode(self.encoding), datasync,
+        return self.operations('fsync', self._decode(path), datasync,
                                         fh)
 
     def setxattr(self, path, name, value, size, options, *args):
-        return self.operations('setxattr', path.decode(self.encoding),
+        return self.operations('setxattr', self._decode(path),
                                name.decode(self.encoding),
                                string_at(value, size), options, *args)
 
     def getxattr(self, path, name, value, size, *args):
-        ret = self.operations('getxattr', path.decode(self.encoding),
+        ret = self.operations('getxattr', self._decode(path),
                                           name.decode(self.encoding), *args)
 
         retsize = len(ret)
@@ -570,13 +618,12 @@ class FUSE(object):
         # do not truncate
         if retsize > size: return -ERANGE
 
-        buf = create_string_buffer(ret, retsize)    # Does not add trailing 0
-        memmove(value, buf, retsize)
+        memmove(value, ret, retsize)    # Does not add trailing 0
 
         return retsize
 
     def listxattr(self, path, namebuf, size):
-        attrs = self.operations('listxattr', path.decode(self.encoding)) or ''
+        attrs = self.operations('listxattr', self._decode(path)) or ''
         ret = '\x00'.join(attrs).encode(self.encoding) + '\x00'
 
         retsize = len(ret)
@@ -586,25 +633,24 @@ class FUSE(object):
         # do not truncate
         if retsize > size: return -ERANGE
 
-        buf = create_string_buffer(ret, retsize)
-        memmove(namebuf, buf, retsize)
+        memmove(namebuf, ret, retsize)
 
         return retsize
 
     def removexattr(self, path, name):
-        return self.operations('removexattr', path.decode(self.encoding),
+        return self.operations('removexattr', self._decode(path),
                                               name.decode(self.encoding))
 
     def opendir(self, path, fip):
         # Ignore raw_fi
         fip.contents.fh = self.operations('opendir',
-                                          path.decode(self.encoding))
+                                          self._decode(path))
 
         return 0
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path.decode(self.encoding),
+        for item in self.operations('readdir', self._decode(path),
                                                fip.contents.fh):
 
             if isinstance(item, basestring):
@@ -624,12 +670,12 @@ class FUSE(object):
 
     def releasedir(self, path, fip):
         # Ignore raw_fi
-        return self.operations('releasedir', path.decode(self.encoding),
+        return self.operations('releasedir', self._decode(path),
                                              fip.contents.fh)
 
     def fsyncdir(self, path, datasync, fip):
         # Ignore raw_fi
-        return self.operations('fsyncdir', path.decode(self.encoding),
+        return self.operations('fsyncdir', self._decode(path),
                                            datasync, fip.contents.fh)
 
     def init(self, conn):
@@ -639,11 +685,11 @@ class FUSE(object):
         return self.operations('destroy', '/')
 
     def access(self, path, amode):
-        return self.operations('access', path.decode(self.encoding), amode)
+        return self.operations('access', self._decode(path), amode)
 
     def create(self, path, mode, fip):
         fi = fip.contents
-        path = path.decode(self.encoding)
+        path = self._decode(path)
 
         if self.raw_fi:
             return self.operations('create', path, mode, fi)
@@ -657,7 +703,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('truncate', path.decode(self.encoding),
+        return self.operations('truncate', self._decode(path),
                                            length, fh)
 
     def fgetattr(self, path, buf, fip):
@@ -671,7 +717,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        attrs = self.operations('getattr', path.decode(self.encoding), fh)
+        attrs = self.operations('getattr', self._decode(path), fh)
         set_st_attrs(st, attrs)
         return 0
 
@@ -681,7 +727,7 @@ class FUSE(object):
         else:
             fh = fip.contents.fh
 
-        return self.operations('lock', path.decode(self.encoding), fh, cmd,
+        return self.operations('lock', self._decode(path), fh, cmd,
                                        lock)
 
     def utimens(self, path, buf):
@@ -692,10 +738,10 @@ class FUSE(object):
         else:
             times = None
 
-        return self.operations('utimens', path.decode(self.encoding), times)
+        return self.operations('utimens', self._decode(path), times)
 
     def bmap(self, path, blocksize, idx):
-        return self.operations('bmap', path.decode(self.encoding), blocksize,
+        return self.operations('bmap', self._decode(path), blocksize,
                                        idx)
 
 
@@ -881,7 +927,10 @@ class LoggingMixIn:
     log = logging.getLogger('fuse.log-mixin')
 
     def __call__(self, op, path, *args):
-        self.log.debug('-> %s %s %s', op, path, repr(args))
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return getattr(self, op)(path, *args)
+
+        self.log.debug('-> %s %s %r', op, path, args)
         ret = '[Unhandled Exception]'
         try:
             ret = getattr(self, op)(path, *args)
@@ -890,4 +939,4 @@ class LoggingMixIn:
             ret = str(e)
             raise
         finally:
-            self.log.debug('<- %s %s', op, repr(ret))
+            self.log.debug('<- %s %r', op, ret)
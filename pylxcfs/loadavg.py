@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+import array
+import logging
+import math
+import threading
+import time
+
+
+class Load(object):
+    __slots__ = ('avenrun', 'running', 'tasks', 'last_pid', 'read')
+
+    def __init__(self, active, running, tasks, last_pid, read):
+        # 1, 5 and 15 minute averages
+        self.avenrun = array.array('d', (active, active, active))
+        self.running = running
+        self.tasks = tasks
+        self.last_pid = last_pid
+        self.read = read
+
+
+class LoadSampler:
+    '''
+    Per cgroup load averages, maintained the way the kernel maintains the
+    host ones: every `interval` seconds a single background thread counts
+    the runnable and uninterruptible tasks of every tracked cgroup and
+    folds the count into exponentially decayed 1, 5 and 15 minute averages.
+
+    count(cgroup, max_tasks) returns (active, running, tasks, last pid) of
+    a cgroup, looking at no more than about max_tasks tasks. A cgroup is
+    tracked from its first get() on, starting from its current count, and
+    forgotten once it hasn't been read for `idle` seconds or is gone, so
+    the cost of a sample only grows with the containers actually reading
+    their load.
+    '''
+
+    log = logging.getLogger("pylxcfs.loadavg")
+
+    def __init__(self, count, interval=5, max_tasks=4096, idle=900):
+        self.count = count
+        self.interval = interval
+        self.max_tasks = max_tasks
+        self.idle = idle
+        self.__loads = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def get(self, cgroup):
+        """
+            Returns (1, 5, 15 minute averages, running, tasks, last pid) of
+            a cgroup.
+        """
+
+        now = time.time()
+        with self.__lock:
+            load = self.__loads.get(cgroup)
+            if load is not None:
+                load.read = now
+
+        if load is None:
+            active, running, tasks, last_pid = self.count(cgroup,
+                                                          self.max_tasks)
+            load = Load(active, running, tasks, last_pid, now)
+            with self.__lock:
+                load = self.__loads.setdefault(cgroup, load)
+
+        return tuple(load.avenrun) + (load.running, load.tasks, load.last_pid)
+
+    def start(self):
+        if not self.interval or self.__thread is not None:
+            return
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="pylxcfs-loadavg")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def sample(self):
+        """
+            Counts the tasks of every tracked cgroup and updates its
+            averages.
+        """
+
+        decay = [math.exp(-float(self.interval) / period)
+                 for period in (60, 300, 900)]
+
+        now = time.time()
+        with self.__lock:
+            loads = self.__loads.items()
+
+        for cgroup, load in loads:
+            if now - load.read > self.idle:
+                self.__forget(cgroup)
+                continue
+            try:
+                active, running, tasks, last_pid = self.count(cgroup,
+                                                              self.max_tasks)
+            except (IOError, OSError):
+                # removed
+                self.__forget(cgroup)
+                continue
+
+            avenrun = load.avenrun
+            for i in range(3):
+                avenrun[i] = avenrun[i] * decay[i] + active * (1 - decay[i])
+            load.running = running
+            load.tasks = tasks
+            load.last_pid = last_pid
+
+    def __forget(self, cgroup):
+        with self.__lock:
+            self.__loads.pop(cgroup, None)
+
+    def __run(self):
+        # The decay assumes samples exactly `interval` apart, don't let the
+        # time spent sampling add up.
+        deadline = time.time()
+        while True:
+            deadline += self.interval
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # sampling takes longer than the interval, don't catch up
+                deadline -= delay
+            try:
+                self.sample()
+            except Exception:
+                self.log.exception("sampling the load failed")
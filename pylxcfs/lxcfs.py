@@ -1,54 +1,27 @@
 #!/usr/bin/python
 
+import collections
 import errno
+import itertools
 import os
+import select
 import stat
+import threading
 import time
 import sys
 import pylxcfs.fuse as fuse
+from pylxcfs.cache import ProcCache
+from pylxcfs.cpuacct import CpuacctStore
+from pylxcfs.fdpool import FilePool
+from pylxcfs.loadavg import LoadSampler
+from pylxcfs.refresh import Refresher
+from pylxcfs.stats import Stats
+from pylxcfs.trace import TraceRecorder
+from pylxcfs.watch import CgroupWatcher
 
 
+CLK_TCK = os.sysconf("SC_CLK_TCK")
 
-class ProcCache:
-    '''
-    Simple "file cache" class. Any entry with the timestamp > __utd_time assumes as outdated 
-    and should be updated. Any read do refresh the timestamp for a cgroup, cgroups with the
-    timestamp > __retention  wipes out during update().
-    '''
-
-    __retention = 60
-    __utd_time = 10
-
-    def __init__(self):
-        self.__cache = {}
-
-    def __cached(self,cgroup,entry):
-        return cgroup in self.__cache.keys() and entry in self.__cache[cgroup].keys()
-
-    def cache_isuptodate(self,cgroup,entry):
-        if cgroup not in self.__cache.keys():  self.__cache[cgroup] = {}
-        self.__cache[cgroup]['t'] = time.time()
-        return self.__cached(cgroup,entry) and self.__cache[cgroup][entry]['t'] > self.__cache[cgroup]['t'] - self.__utd_time
-
-    def get(self,cgroup,entry):
-        #if self.__cached(self,cgroup,entry):
-        #    self.__cache[cgroup]['t'] = time.time()
-            return self.__cache[cgroup][entry]['c']
-        #else:
-        #    return None
-
-    def update(self,cgroup,entry,content):
-        if cgroup not in self.__cache.keys():  self.__cache[cgroup] = {}
-        if entry not in self.__cache[cgroup].keys(): self.__cache[cgroup][entry] = {}
-        self.__cache[cgroup]['t'] = time.time()
-        self.__cache[cgroup][entry]['t'] = self.__cache[cgroup]['t']
-        self.__cache[cgroup][entry]['c'] = content
-        for e in filter(lambda x:
-                                  self.__cache[cgroup]['t'] -
-                                  self.__cache[x]['t'] >
-                                  self.__retention, self.__cache.keys()):
-           del self.__cache[e]
-        
 
 def expand_range(intrange):
     """
@@ -68,94 +41,267 @@ def expand_range(intrange):
     return result
 
 
-def get_controller_paths():
-    controlles = {'cpuset':None, 'cpu':None, 'cpuacct':None, 'memory':None, 'devices':None,
-                  'freezer':None, 'net_cls':None, 'blkio':None, 'perf_event':None, 'hugetlb':None}
-    with open("/proc/mounts","r") as fd:
-        for line in fd:
-            if line.startswith("cgroup") and filter(lambda k: k in line, controlles.keys()):
-               fields = line.split()
-               for k in filter(lambda c: c in controlles.keys(), fields[3].split(",")):
-                   controlles[k] = fields[1]
-    return controlles
+class ControllerMap:
+    '''
+    Process wide map of cgroup controller -> hierarchy mount point. The
+    mount table is scanned once and then only rescanned after the kernel
+    flags /proc/self/mountinfo with POLLPRI, i.e. after a mount or umount
+    in our namespace; checking for that is a single non-blocking poll().
+    '''
+
+    def __init__(self):
+        self.__fd = open("%s/proc/self/mountinfo" % host_root, "r")
+        self.__poll = select.poll()
+        self.__poll.register(self.__fd, select.POLLPRI | select.POLLERR)
+        self.__lock = threading.Lock()
+        self.__paths = self.__scan()
+
+    def __scan(self):
+        controlles = {'cpuset':None, 'cpu':None, 'cpuacct':None, 'memory':None, 'devices':None,
+                      'freezer':None, 'net_cls':None, 'blkio':None, 'perf_event':None, 'hugetlb':None}
+        self.__fd.seek(0)
+        for line in self.__fd:
+            mount, fs = line.split(" - ", 1)
+            fs = fs.split()
+            if fs[0] != "cgroup":
+                continue
+            for k in filter(lambda c: c in controlles.keys(), fs[2].split(",")):
+                controlles[k] = host_root + mount.split()[4]
+        return controlles
+
+    def close(self):
+        with self.__lock:
+            self.__fd.close()
+
+    def get(self, controller):
+        """
+            Returns the mount point of the hierarchy the controller is
+            attached to, or None if it isn't mounted.
+        """
+
+        with self.__lock:
+            if self.__poll.poll(0):
+                self.__paths = self.__scan()
+            return self.__paths[controller]
 
 
 def get_cgroup_value(c_path,cgroup,key):
-    with open("%s/%s/%s" % (c_path,cgroup,key), "r") as fd:
-        v = fd.read()
-    return v.strip()
+    return cgroup_files.read("%s/%s/%s" % (c_path,cgroup,key)).strip()
 
 
-def get_cgroup(pid, controller):
+def get_static_value(controller, cgroup, key, parse=str):
     """
-        Takes a pid and a cgroup controller name and returns the full
-        cgroup path for that task.
+        Returns parse() of a cgroup value that only changes when it is
+        written to (limits, cpusets). It is cached under the file name
+        until the watcher reports a write, or for the regular cache ttl if
+        the file can't be watched.
     """
 
-    with open("/proc/%s/cgroup" % pid, "r") as fd:
-        for line in fd:
-            fields = line.split(":")
-            if fields[1] == controller:
-                return fields[2].strip()
+    def load():
+        c_path = controllers.get(controller)
+        ttl = None
+        if watcher.watch(c_path, cgroup, key, key):
+            ttl = watcher.ttl
+        return cache.update(cgroup, key,
+                            parse(get_cgroup_value(c_path, cgroup, key)),
+                            ttl=ttl)
 
+    return cache.fetch(cgroup, key, load)
 
-def get_cpuinfo():
-    """
-        Generates a new /proc/cpuinfo
-    """
 
-    uid, gid, pid = fuse.fuse_get_context()
+class CgroupResolver:
+    '''
+    Bounded LRU cache of pid -> {controller: cgroup}. Entries are keyed by
+    the pid and its start token (the ctime of /proc/<pid>, which get_uptime
+    already treats as the process start), so a recycled pid never inherits
+    the cgroups of a dead task. All controllers of a pid come from a single
+    parse of /proc/<pid>/cgroup.
+
+    A live task can be moved to another cgroup (cgclassify, a write to
+    tasks), which changes neither key, so entries are also only used for
+    `ttl` seconds.
+    '''
+
+    def __init__(self, size=4096, ttl=10):
+        self.ttl = ttl
+        self.__size = size
+        self.__cache = collections.OrderedDict()
+        self.__lock = threading.Lock()
 
-    cgroup = get_cgroup(pid, "cpuset")
+    def resolve(self, pid):
+        key = (pid, os.stat("%s/proc/%s" % (host_root, pid)).st_ctime)
+        now = time.time()
 
-    if cache.cache_isuptodate(cgroup,"cpuinfo"):
-        return cache.get(cgroup,"cpuinfo")
+        with self.__lock:
+            entry = self.__cache.pop(key, None)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.__cache[key] = entry
+                return entry[1]
 
-    if not cache.cache_isuptodate(cgroup,"ctrs"):
-        cache.update(cgroup,"ctrs",get_controller_paths())
-     
-    ctrs = cache.get(cgroup,"ctrs") 
+        cgroups = {}
+        with open("%s/proc/%s/cgroup" % (host_root, pid), "r") as fd:
+            for line in fd:
+                fields = line.split(":", 2)
+                for controller in fields[1].split(","):
+                    cgroups[controller] = fields[2].strip()
 
-    # Grab the current global values
-    with open("/proc/cpuinfo", "r") as fd:
-        cpus = fd.read().split("\n\n")
+        with self.__lock:
+            self.__cache[key] = (now, cgroups)
+            while len(self.__cache) > self.__size:
+                self.__cache.popitem(last=False)
+        return cgroups
 
-    value = get_cgroup_value(ctrs["cpuset"],
-                             cgroup,
-                            "cpuset.cpus")
 
-    # Generate the new cpuinfo
-    entries = []
-    count = 0
-    for i in expand_range(value):
-        entries.append(cpus[i].replace("processor\t: %s" % i,
-                                       "processor\t: %s" % count))
-        count += 1
+def get_cgroup(pid, controller):
+    """
+        Takes a pid and a cgroup controller name and returns the full
+        cgroup path for that task.
+    """
 
-    cache.update(cgroup,"cpuinfo","%s\n" % "\n\n".join(entries))
-    return cache.get(cgroup,"cpuinfo")
+    return resolver.resolve(pid).get(controller)
 
 
-def get_meminfo():
+def get_pid_starttime(pid):
     """
-        Generates a new /proc/meminfo
+        Returns the start time of a process in seconds since boot.
     """
 
-    uid, gid, pid = fuse.fuse_get_context()
+    with open("%s/proc/%s/stat" % (host_root, pid), "r") as fd:
+        value = fd.read()
 
-    # Grab the current cgroup values
-    cgroup = get_cgroup(pid, "memory")
+    # comm may contain spaces and parentheses, count fields from the last
+    # ')': starttime is field 22, state (field 3) is the first one after it.
+    return int(value[value.rindex(")") + 2:].split()[19]) / float(CLK_TCK)
 
-    if cache.cache_isuptodate(cgroup,"meminfo"):
-        return cache.get(cgroup,"meminfo")
 
-    if not cache.cache_isuptodate(cgroup,"ctrs"):
-        cache.update(cgroup,"ctrs",get_controller_paths())
+def get_cgroup_init(cgroup):
+    """
+        Returns the start time (in seconds since boot) of the oldest process
+        of a cpuset cgroup, i.e. the container init, or None if the cgroup
+        is empty.
+
+        The processes are only scanned once per cgroup lifetime: the cached
+        init is dropped by the watcher when the cgroup is removed. Without
+        a watch it is revalidated with a single stat(2) of its /proc entry,
+        whose ctime changes if the pid gets reused.
+    """
+
+    init = cache.lookup(cgroup, "init")
+    if init is not None:
+        pid, token, started, watched = init
+        if watched:
+            return started
+        try:
+            if os.stat("%s/proc/%s" % (host_root, pid)).st_ctime == token:
+                return started
+        except OSError:
+            pass
+
+    c_path = controllers.get("cpuset")
+    watched = watcher.watch(c_path, cgroup, None, "init")
+
+    init = None
+    for pid in get_cgroup_value(c_path, cgroup, "cgroup.procs").split():
+        try:
+            token = os.stat("%s/proc/%s" % (host_root, pid)).st_ctime
+            started = get_pid_starttime(pid)
+        except (IOError, OSError):
+            # exited while we were scanning
+            continue
+        if init is None or started < init[2]:
+            init = (pid, token, started, watched)
+
+    if init is None:
+        return None
+    cache.update(cgroup, "init", init, ttl=float("inf"))
+    return init[2]
+
+
+# Host snapshots: the host files are parsed at most once per cache ttl and
+# shared by every container, they are cached under the None cgroup.
+# /proc/cpuinfo is mostly static and has its own source below.
+
+class CpuinfoSource:
+    '''
+    Host /proc/cpuinfo, parsed once into per CPU blocks indexed by processor
+    number, with the processor line cut out so renumbering is a single
+    format. Reading the file makes the kernel sample the frequency of every
+    CPU, so it is only re-read every mhz_interval seconds to refresh the
+    volatile "cpu MHz" fields, or never if mhz_interval is 0.
+    '''
 
-    ctrs = cache.get(cgroup,"ctrs")
+    def __init__(self, mhz_interval=300):
+        self.mhz_interval = mhz_interval
+        self.__lock = threading.Lock()
+        self.__blocks = {}
+        self.__mhz = {}
+        self.__generation = 0
+        self.__refresh()
+
+    def __refresh(self):
+        with open("%s/proc/cpuinfo" % host_root, "r") as fd:
+            blocks = fd.read().split("\n\n")
+
+        for block in blocks:
+            lines = block.split("\n")
+            if not lines[0].startswith("processor"):
+                continue
+            cpu = int(lines[0].split(":")[1])
+
+            # Every line but the processor one is kept with its leading
+            # newline, so a block without a cpu MHz line (arm64, s390x)
+            # is rebuilt exactly too.
+            mhz = ""
+            for i, line in enumerate(lines):
+                if line.startswith("cpu MHz"):
+                    mhz = "\n%s" % line
+                    break
+            else:
+                i = len(lines)
+
+            self.__mhz[cpu] = mhz
+            if cpu not in self.__blocks:
+                self.__blocks[cpu] = ("".join("\n%s" % l for l in lines[1:i]),
+                                      "".join("\n%s" % l
+                                              for l in lines[i + 1:]))
+
+        self.__stamp = time.time()
+        self.__generation += 1
+
+    def generation(self):
+        """
+            Refreshes the volatile fields if they are due and returns a
+            number that changes whenever they were.
+        """
+
+        with self.__lock:
+            if (self.mhz_interval and
+                time.time() - self.__stamp >= self.mhz_interval):
+                self.__refresh()
+            return self.__generation
+
+    def render(self, mask):
+        """
+            Returns the cpuinfo blocks of the CPUs in mask, renumbered from 0.
+        """
+
+        with self.__lock:
+            entries = []
+            for count, cpu in enumerate(mask):
+                before, after = self.__blocks[cpu]
+                entries.append("processor\t: %s%s%s%s" % (count, before,
+                                                          self.__mhz[cpu],
+                                                          after))
+            return "%s\n" % "\n\n".join(entries)
+
+
+def load_host_meminfo(key=None):
+    """
+        Parses the host /proc/meminfo into a list of (key, value, unit).
+    """
 
     meminfo = []
-    with open("/proc/meminfo", "r") as fd:
+    with open("%s/proc/meminfo" % host_root, "r") as fd:
         for line in fd:
             fields = line.split(":")
 
@@ -169,18 +315,163 @@ def get_meminfo():
 
             meminfo.append((key, value, unit))
 
+    return cache.update(None, "meminfo", meminfo)
+
+
+def get_host_meminfo():
+    """
+        Returns the current host /proc/meminfo snapshot.
+    """
+
+    refresher.touch(load_host_meminfo, None)
+    return cache.fetch(None, "meminfo", load_host_meminfo)
+
+
+def load_host_stat(key=None):
+    """
+        Parses the host /proc/stat into (head, cpus, tail): the lines before
+        the per CPU lines, a dict of CPU number -> the rest of its "cpuN"
+        line and everything after them.
+    """
+
+    head, cpus, tail = [], {}, []
+    with open("%s/proc/stat" % host_root, "r") as fd:
+        for line in fd:
+            if line.startswith("cpu") and not line.startswith("cpu "):
+                sep = line.index(" ")
+                cpus[int(line[3:sep])] = line[sep:]
+            elif cpus:
+                tail.append(line)
+            else:
+                head.append(line)
+
+    return cache.update(None, "stat", ("".join(head), cpus, "".join(tail)))
+
+
+def get_host_stat():
+    """
+        Returns the current host /proc/stat snapshot.
+    """
+
+    refresher.touch(load_host_stat, None)
+    return cache.fetch(None, "stat", load_host_stat)
+
+
+def load_host_diskstats(key=None):
+    """
+        Parses the host /proc/diskstats into a list of ((major, minor),
+        line) in the order of the file.
+    """
+
+    disks = []
+    with open("%s/proc/diskstats" % host_root, "r") as fd:
+        for line in fd:
+            fields = line.split()
+            disks.append(((int(fields[0]), int(fields[1])), line))
+
+    return cache.update(None, "diskstats", disks)
+
+
+def get_host_diskstats():
+    """
+        Returns the current host /proc/diskstats snapshot.
+    """
+
+    refresher.touch(load_host_diskstats, None)
+    return cache.fetch(None, "diskstats", load_host_diskstats)
+
+
+def get_cpuset(cgroup):
+    """
+        Returns the cpuset.cpus of a cgroup normalized to a sorted tuple of
+        CPU numbers.
+
+        Views that only depend on the cpuset (cpuinfo, stat) are cached
+        under this mask instead of the cgroup, so containers sharing a mask
+        share one rendering.
+    """
+
+    return get_static_value("cpuset", cgroup, "cpuset.cpus",
+                            lambda v: tuple(sorted(set(expand_range(v)))))
+
+
+# Trim the CPU views to the CFS quota of the caller, see get_cpus().
+cpu_quota = False
+
+
+def get_cpu_limit(cgroup):
+    """
+        Returns the number of CPUs the CFS quota of a cpu cgroup amounts
+        to, ceil(cfs_quota_us / cfs_period_us), or None if it has no quota.
+    """
+
+    quota = get_static_value("cpu", cgroup, "cpu.cfs_quota_us", int)
+    if quota <= 0:
+        return None
+    period = get_static_value("cpu", cgroup, "cpu.cfs_period_us", int)
+    return max(-(-quota // period), 1)
+
+
+def get_cpus(pid):
+    """
+        Returns the CPUs a task is shown: its cpuset, or with cpu_quota set
+        only the first CPUs of it its CFS quota allows, so runtimes sizing
+        their thread pools by the CPU count don't oversubscribe the quota.
+    """
+
+    mask = get_cpuset(get_cgroup(pid, "cpuset"))
+    cgroup = get_cgroup(pid, "cpu") if cpu_quota else None
+    if cgroup is not None:
+        limit = get_cpu_limit(cgroup)
+        if limit is not None and limit < len(mask):
+            mask = mask[:limit]
+    return mask
+
+
+def get_cpuinfo():
+    """
+        Generates a new /proc/cpuinfo
+    """
+
+    uid, gid, pid = fuse.fuse_get_context()
+
+    mask = get_cpus(pid)
+
+    # Renderings stay valid until the host values are refreshed, which
+    # bumps the generation and so the cache key.
+    entry = ("cpuinfo", host_cpuinfo.generation())
+
+    return cache.fetch(mask, entry,
+                       lambda: cache.update(mask, entry,
+                                            host_cpuinfo.render(mask),
+                                            ttl=float("inf")))
+
+
+def render_meminfo(cgroup):
+    """
+        Renders /proc/meminfo for a memory cgroup
+    """
+
+    meminfo = list(get_host_meminfo())
+
+    mem_path = controllers.get("memory")
+
+    # The rendering embeds the limits, drop it as soon as they change.
+    for key in ("memory.limit_in_bytes", "memory.memsw.limit_in_bytes"):
+        watcher.watch(mem_path, cgroup, key, "meminfo")
+
     cgm = {}
-    cgm['limit_in_bytes'] = int(get_cgroup_value(ctrs["memory"],cgroup,
-                                                 "memory.limit_in_bytes"))
-    cgm['vlimit_in_bytes'] = int(get_cgroup_value(ctrs["memory"],cgroup,
-                                                  "memory.memsw.limit_in_bytes"))
-    cgm['usage_in_bytes'] = int(get_cgroup_value(ctrs["memory"],cgroup,
+    cgm['limit_in_bytes'] = get_static_value("memory", cgroup,
+                                             "memory.limit_in_bytes", int)
+    cgm['vlimit_in_bytes'] = get_static_value("memory", cgroup,
+                                              "memory.memsw.limit_in_bytes", int)
+    cgm['usage_in_bytes'] = int(get_cgroup_value(mem_path,cgroup,
                                                  "memory.usage_in_bytes"))
-    cgm['vusage_in_bytes'] = int(get_cgroup_value(ctrs["memory"],cgroup,
+    cgm['vusage_in_bytes'] = int(get_cgroup_value(mem_path,cgroup,
                                                   "memory.memsw.usage_in_bytes"))
 
 
-    cgm_stat = get_cgroup_value(ctrs["memory"], cgroup, "memory.stat")
+    cgm_stat = get_cgroup_value(mem_path, cgroup, "memory.stat")
     cgm['stat'] = {}
     for line in cgm_stat.split("\n"):
         fields = line.split()
@@ -228,8 +519,77 @@ def get_meminfo():
             output += "{key:15} {value}\n".format(key="%s:" % key,
                                                   value="%8lu" % value)
 
-    cache.update(cgroup,"meminfo",output)
-    return cache.get(cgroup,"meminfo")
+    return cache.update(cgroup, "meminfo", output)
+
+
+def get_meminfo():
+    """
+        Generates a new /proc/meminfo
+    """
+
+    uid, gid, pid = fuse.fuse_get_context()
+
+    # Grab the current cgroup values
+    cgroup = get_cgroup(pid, "memory")
+    refresher.touch(render_meminfo, cgroup)
+    return cache.fetch(cgroup, "meminfo", lambda: render_meminfo(cgroup))
+
+
+def get_cpuacct(cgroup, cpus, host):
+    """
+        Returns per CPU lists of the user, system and idle ticks of a
+        cpuacct cgroup on the given host CPUs; host is the per CPU rest of
+        the host /proc/stat "cpuN" lines.
+    """
+
+    c_path = controllers.get("cpuacct")
+    usage = get_cgroup_value(c_path, cgroup, "cpuacct.usage_percpu").split()
+    stat = dict(line.split() for line in
+                get_cgroup_value(c_path, cgroup, "cpuacct.stat").split("\n"))
+
+    # cpuacct counts nanoseconds, /proc/stat USER_HZ ticks
+    ticks = CLK_TCK / 1e9
+    return cpuacct_views.update(
+        cgroup, tuple(cpus),
+        [int(usage[cpu]) * ticks for cpu in cpus],
+        (int(stat["user"]), int(stat["system"])),
+        # user nice system idle iowait irq softirq steal, guest is in user
+        [sum(map(int, host[cpu].split()[:8])) for cpu in cpus])
+
+
+def render_stat(key):
+    """
+        Renders /proc/stat for a (cpuacct cgroup, cpuset mask) key, with the
+        CPU times of the cgroup, or of the host if it has no cpuacct.
+    """
+
+    cgroup, mask = key
+    head, cpus, tail = get_host_stat()
+    online = [cpu for cpu in mask if cpu in cpus]
+
+    times = None
+    if cgroup is not None and controllers.get("cpuacct") is not None:
+        try:
+            times = get_cpuacct(cgroup, online, cpus)
+        except (IOError, OSError):
+            # the cgroup is gone
+            pass
+
+    if times is None:
+        output = "".join([head] +
+                         ["cpu%d%s" % (count, cpus[cpu])
+                          for count, cpu in enumerate(online)] +
+                         [tail])
+    else:
+        user, system, idle = times
+        line = "cpu%s %d 0 %d %d 0 0 0 0 0 0\n"
+        output = "".join([line % (" ", sum(user), sum(system), sum(idle))] +
+                         [line % (count, u, s, i)
+                          for count, (u, s, i)
+                          in enumerate(zip(user, system, idle))] +
+                         [tail])
+
+    return cache.update(cgroup, ("stat", mask), output)
 
 
 def get_stat():
@@ -239,38 +599,94 @@ def get_stat():
 
     uid, gid, pid = fuse.fuse_get_context()
 
-    cgroup = get_cgroup(pid, "cpuset")
+    key = (get_cgroup(pid, "cpuacct"), get_cpus(pid))
+    refresher.touch(render_stat, key)
+    return cache.fetch(key[0], ("stat", key[1]), lambda: render_stat(key))
 
-    if cache.cache_isuptodate(cgroup,"stat"):
-        return cache.get(cgroup,"stat")
 
-    if not cache.cache_isuptodate(cgroup,"ctrs"):
-        cache.update(cgroup,"ctrs",get_controller_paths())
+def get_blkio_value(c_path, cgroup, key):
+    """
+        Parses a blkio statistics file into a dict of (major, minor) ->
+        {operation: value}. Files of an inactive policy (CFQ, BFQ) may be
+        missing, they are empty.
+    """
 
-    ctrs = cache.get(cgroup,"ctrs")
+    try:
+        content = get_cgroup_value(c_path, cgroup, key)
+    except (IOError, OSError):
+        if key.startswith("blkio.throttle."):
+            raise
+        return {}
 
-    value = expand_range(get_cgroup_value(ctrs["cpuset"],
-                                          cgroup,
-                                          "cpuset.cpus"))
+    devices = {}
+    for line in content.split("\n"):
+        fields = line.split()
+        # skips the trailing "Total N"
+        if len(fields) != 3:
+            continue
+        major, minor = fields[0].split(":")
+        devices.setdefault((int(major), int(minor)), {})[fields[1]] = \
+            int(fields[2])
+    return devices
 
-    output = ""
-    count = 0
-    with open("/proc/stat", "r") as fd:
-        for line in fd:
-            if line.startswith("cpu") and not line.startswith("cpu "):
-                for cpu in value:
-                    if not line.startswith("cpu%s" % cpu):
-                        continue
 
-                    line = line.replace("cpu%s" % cpu, "cpu%s" % count)
-                    count += 1
-                    break
-                else:
-                    continue
-            output += line
+def render_diskstats(cgroup):
+    """
+        Renders /proc/diskstats for a blkio cgroup: the host devices the
+        cgroup did I/O on, with its own counters.
+    """
+
+    disks = get_host_diskstats()
+
+    c_path = controllers.get("blkio")
+    try:
+        nbytes = get_blkio_value(c_path, cgroup,
+                                 "blkio.throttle.io_service_bytes")
+        serviced = get_blkio_value(c_path, cgroup,
+                                   "blkio.throttle.io_serviced")
+    except (IOError, OSError):
+        return cache.update(cgroup, "diskstats",
+                            "".join(line for device, line in disks))
+    service_time = get_blkio_value(c_path, cgroup, "blkio.io_service_time")
+    wait_time = get_blkio_value(c_path, cgroup, "blkio.io_wait_time")
+    merged = get_blkio_value(c_path, cgroup, "blkio.io_merged")
+
+    empty = {}
+    output = []
+    for device, line in disks:
+        ios = serviced.get(device)
+        if ios is None:
+            continue
+        size = nbytes.get(device, empty)
+        service = service_time.get(device, empty)
+        wait = wait_time.get(device, empty)
+        merges = merged.get(device, empty)
+        name = line.split(None, 3)[2]
+
+        # times are in nanoseconds, diskstats has milliseconds
+        output.append("%4d %7d %s %d %d %d %d %d %d %d %d %d %d %d\n" % (
+            device[0], device[1], name,
+            ios.get("Read", 0), merges.get("Read", 0),
+            size.get("Read", 0) // 512, service.get("Read", 0) // 1000000,
+            ios.get("Write", 0), merges.get("Write", 0),
+            size.get("Write", 0) // 512, service.get("Write", 0) // 1000000,
+            0, service.get("Total", 0) // 1000000,
+            (service.get("Total", 0) + wait.get("Total", 0)) // 1000000))
+
+    return cache.update(cgroup, "diskstats", "".join(output))
+
+
+def get_diskstats():
+    """
+        Generates a new /proc/diskstats
+    """
+
+    uid, gid, pid = fuse.fuse_get_context()
 
-    cache.update(cgroup,"stat",output)
-    return cache.get(cgroup,"stat")
+    cgroup = get_cgroup(pid, "blkio")
+    refresher.touch(render_diskstats, cgroup)
+    return cache.fetch(cgroup, "diskstats",
+                       lambda: render_diskstats(cgroup))
 
 
 def get_uptime():
@@ -280,84 +696,302 @@ def get_uptime():
 
     uid, gid, pid = fuse.fuse_get_context()
 
-    cgroup = get_cgroup(pid, "cpuset")
+    started = get_cgroup_init(get_cgroup(pid, "cpuset"))
 
-    if not cache.cache_isuptodate(cgroup,"ctrs"):
-        cache.update(cgroup,"ctrs",get_controller_paths())
+    with open("%s/proc/uptime" % host_root, "r") as fd:
+        fields = fd.read().split()
 
-    ctrs = cache.get(cgroup,"ctrs")
+    if started is not None:
+        fields[0] = "%.2f" % max(float(fields[0]) - started, 0)
 
-    if not cache.cache_isuptodate(cgroup,"oldest_pid"):
-        value = [ int(v) 
-                  for v in get_cgroup_value(ctrs["cpuset"],cgroup,"tasks").split("\n") ]
-        oldest_pid = sorted([os.stat("/proc/%s" % entry).st_ctime
-                             for entry in value])[0]
-        cache.update(cgroup,"oldest_pid",oldest_pid)
+    return "%s\n" % " ".join(fields)
 
-    oldest_pid = cache.get(cgroup,"oldest_pid")
 
-    with open("/proc/uptime", "r") as fd:
-        fields = fd.read().split()
-        fields[0] = str(round(time.time() - oldest_pid, 2))
+def count_tasks(cgroup, max_tasks):
+    """
+        Returns (active, running, tasks, last pid) of a cpuset cgroup:
+        active counts the runnable and uninterruptible tasks that make up
+        the load, running only the runnable ones. Of large cgroups only
+        about max_tasks evenly spread tasks are looked at and the counts
+        scaled up.
+    """
 
-    return "%s\n" % " ".join(fields)
+    tids = get_cgroup_value(controllers.get("cpuset"), cgroup,
+                            "tasks").split()
+    if not tids:
+        return 0, 0, 0, 0
+
+    step = max(len(tids) // max(max_tasks, 1), 1)
+    active = running = 0
+    for tid in tids[::step]:
+        try:
+            with open("%s/proc/%s/stat" % (host_root, tid), "r") as fd:
+                value = fd.read()
+        except (IOError, OSError):
+            # exited since tasks was read
+            continue
+        state = value[value.rindex(")") + 2]
+        if state == "R":
+            running += 1
+            active += 1
+        elif state == "D":
+            active += 1
+
+    return active * step, running * step, len(tids), max(map(int, tids))
+
+
+def get_loadavg():
+    """
+        Generates a new /proc/loadavg
+    """
+
+    if not load_sampler.interval:
+        with open("%s/proc/loadavg" % host_root, "r") as fd:
+            return fd.read()
+
+    uid, gid, pid = fuse.fuse_get_context()
+
+    avg1, avg5, avg15, running, tasks, last_pid = \
+        load_sampler.get(get_cgroup(pid, "cpuset"))
+    return "%.2f %.2f %.2f %d/%d %d\n" % (avg1, avg5, avg15, running, tasks,
+                                          last_pid)
+
+
+def get_cpu_online():
+    """
+        Generates /sys/devices/system/cpu/{online,possible,present}
+    """
+
+    uid, gid, pid = fuse.fuse_get_context()
+
+    # The CPU views number the CPUs of the container from 0.
+    count = len(get_cpus(pid))
+    if count == 1:
+        return "0\n"
+    return "0-%d\n" % (count - 1)
+
+
+def get_stats():
+    """
+        Generates /.pylxcfs/stats
+    """
+
+    return stats.render()
+
+
+def record_op(start, op, path, args, latency):
+    """
+        Appends a handled operation with its caller to the trace.
+    """
+
+    uid, gid, pid = fuse.fuse_get_context()
+    try:
+        cgroup = get_cgroup(pid, "cpuset")
+    except (IOError, OSError):
+        # release() and friends have no caller
+        cgroup = None
+
+    fh = size = offset = 0
+    if op == "read":
+        size, offset, fi = args
+        fh = fi.fh
+    elif op in ("open", "release"):
+        fh = args[0].fh
+
+    recorder.record(start, op, path, cgroup, pid, fh & 0xffffffff, size,
+                    offset, latency)
+
+
+def observe_render(entry, seconds):
+    # entries may carry a generation, e.g. ("cpuinfo", 3)
+    if isinstance(entry, tuple):
+        entry = entry[0]
+    stats.observe("render", entry, seconds)
 
 
 # List of supported files with their callback function
 files = {'/proc/cpuinfo': get_cpuinfo,
+         '/proc/diskstats': get_diskstats,
+         '/proc/loadavg': get_loadavg,
          '/proc/meminfo': get_meminfo,
          '/proc/stat': get_stat,
-         '/proc/uptime': get_uptime}
+         '/proc/uptime': get_uptime,
+         '/sys/devices/system/cpu/online': get_cpu_online,
+         '/sys/devices/system/cpu/possible': get_cpu_online,
+         '/sys/devices/system/cpu/present': get_cpu_online}
+
+# Files of the daemon itself, only readable by root
+admin_files = {'/.pylxcfs/stats': get_stats}
+
+
+def directories(paths):
+    """
+        Returns the readdir() listing of every directory of the tree
+        holding paths.
+    """
+
+    tree = {"/": set()}
+    for path in paths:
+        while path != "/":
+            parent, name = os.path.split(path)
+            tree.setdefault(parent, set()).add(name)
+            path = parent
+    return dict((path, ['.', '..'] + sorted(names))
+                for path, names in tree.items())
 
 
 class LXCFuse(fuse.LoggingMixIn, fuse.Operations):
-    def __init__(self, path='.'):
-        self.root = path
+    '''
+    Expects to be mounted with raw_fi=True: files are opened in direct_io
+    mode, so the kernel reads until EOF regardless of st_size and getattr
+    never has to render a file just to report its length (like procfs,
+    the virtual files report a size of 0).
+
+    The attributes and the tree are the same for every caller and never
+    change, so the kernel may cache lookups and attributes for as long as
+    it likes (entry_timeout, attr_timeout). The content must not be cached:
+    the page cache of a file is shared by all containers, which would see
+    each other's views.
+
+    Safe to use with a multithreaded FUSE loop; at most `threads` files are
+    rendered concurrently, other operations are never held back.
+
+    Every operation is timed into the module stats, served to root as
+    /.pylxcfs/stats, and appended to the trace if recording.
+
+    If root is given, the host files are read below it instead of "/", see
+    setup().
+    '''
+
+    def __init__(self, root=None, threads=1):
+        if root is not None:
+            setup(root)
+        # path -> (st_mode, st_nlink), and the directory listings
+        self.directories = directories(list(files) + list(admin_files))
+        self.nodes = dict((path, (stat.S_IFDIR | 0o755, 2))
+                          for path in self.directories)
+        self.nodes.update((path, (stat.S_IFREG | 0o444, 1))
+                          for path in files)
+        self.nodes.update((path, (stat.S_IFREG | 0o400, 1))
+                          for path in admin_files)
+        # Content rendered at open() time, keyed by file handle, so that
+        # every read() on a handle slices the same snapshot.
+        self.handles = {}
+        self.fh_counter = itertools.count(1)
+        self.workers = threading.BoundedSemaphore(max(threads, 1))
+
+    def __call__(self, op, path, *args):
+        start = time.time()
+        try:
+            return super(LXCFuse, self).__call__(op, path, *args)
+        finally:
+            elapsed = time.time() - start
+            stats.observe("op", op, elapsed)
+            if recorder.enabled:
+                record_op(start, op, path, args, elapsed)
 
     def getattr(self, path, fh=None):
-        st = {}
-        st['st_atime'] = time.time()
-        st['st_ctime'] = time.time()
-        st['st_mtime'] = time.time()
-
-        if path == "/":
-            st['st_mode'] = stat.S_IFDIR | 0o755
-            st['st_nlink'] = 2
-        elif path == "/proc":
-            st['st_mode'] = stat.S_IFDIR | 0o755
-            st['st_nlink'] = 2
-        elif path in files:
-            st['st_mode'] = stat.S_IFREG | 0o444
-            st['st_nlink'] = 1
-            st['st_size'] = len(files[path]())
-        else:
+        node = self.nodes.get(path)
+        if node is None:
             raise fuse.FuseOSError(errno.ENOENT)
-        return st
+
+        now = time.time()
+        return {'st_mode': node[0], 'st_nlink': node[1], 'st_size': 0,
+                'st_atime': now, 'st_ctime': now, 'st_mtime': now}
+
+    def init(self, path):
+        watcher.start()
+        refresher.start()
+        load_sampler.start()
 
     def readdir(self, path, fh):
-        if path == "/":
-            return ['.', '..', 'proc']
-        elif path == "/proc":
-            return ['.', '..'] + [os.path.basename(entry)
-                                  for entry in files.keys()
-                                  if entry.startswith("/proc/")]
-        else:
+        if path not in self.directories:
             raise fuse.FuseOSError(errno.ENOENT)
+        return self.directories[path]
+
+    def open(self, path, fi):
+        uid, gid, pid = fuse.fuse_get_context()
 
-    def read(self, path, size, offset, fh):
-        if path in files:
-            content = files[path]()
+        if path in admin_files:
+            if uid != 0:
+                raise fuse.FuseOSError(errno.EACCES)
+            content = admin_files[path]()
+        elif path in files:
+            start = time.time()
+            with self.workers:
+                content = files[path]()
+            elapsed = time.time() - start
+
+            # FUSE passes unicode paths, keep the stats (and what they
+            # render) byte strings
+            stats.observe("file", str(path), elapsed)
+            try:
+                stats.observe("cgroup", get_cgroup(pid, "cpuset"), elapsed)
+            except (IOError, OSError):
+                # the caller is already gone
+                pass
         else:
             raise fuse.FuseOSError(errno.ENOENT)
 
-        slen = len(content)
-        if offset < slen:
-            if offset + size > slen:
-                size = slen - offset
-            buf = content[offset:offset+size]
-        else:
-            buf = ''
-        return buf
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+
+        fi.fh = next(self.fh_counter)
+        self.handles[fi.fh] = fuse.Snapshot(content)
+        fi.direct_io = 1
+        return 0
+
+    def read(self, path, size, offset, fi):
+        snapshot = self.handles.get(fi.fh)
+        if snapshot is None:
+            if path not in files:
+                raise fuse.FuseOSError(errno.ENOENT)
+            with self.workers:
+                snapshot = fuse.Snapshot(files[path]())
+
+        # copied into the kernel buffer by FUSE.read, without a slice
+        return snapshot.slice(offset, size)
+
+    def release(self, path, fi):
+        self.handles.pop(fi.fh, None)
+        return 0
+
+
+
+def setup(root="/"):
+    """
+        Creates the process wide state, reading the host files (/proc and
+        the cgroup hierarchies found in its mountinfo) below root. Any root
+        but "/" is a synthetic host, see pylxcfs.bench; every call starts
+        over from an empty cache.
+    """
 
-cache = ProcCache()
+    global host_root, cache, resolver, controllers, host_cpuinfo
+    global watcher, cgroup_files, refresher, stats, load_sampler
+    global cpuacct_views
+
+    if cgroup_files is not None:
+        cgroup_files.close()
+        watcher.close()
+        controllers.close()
+
+    host_root = os.path.abspath(root).rstrip("/")
+    cache = ProcCache()
+    resolver = CgroupResolver()
+    controllers = ControllerMap()
+    host_cpuinfo = CpuinfoSource()
+    watcher = CgroupWatcher(cache.invalidate)
+    cgroup_files = FilePool()
+    refresher = Refresher(cache)
+    stats = Stats(cache)
+    cache.on_render = observe_render
+    load_sampler = LoadSampler(count_tasks)
+    cpuacct_views = CpuacctStore()
+
+
+# Prefix of every host path, "" for the real host.
+host_root = ""
+cgroup_files = None
+setup()
+recorder = TraceRecorder()
 
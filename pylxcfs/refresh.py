@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+import logging
+import threading
+import time
+
+
+class Refresher:
+    '''
+    Optional background thread that re-renders recently read views shortly
+    before their cache entry expires, so the request path nearly always
+    hits the cache.
+
+    A view is a render(key) function that renders and caches one file for
+    one key (cgroup, cpuset mask, None for host snapshots). Readers touch()
+    the views they use; a view is re-rendered `lead` seconds before the
+    cache ttl runs out and forgotten once it hasn't been read for `idle`
+    seconds, so cgroups nobody reads anymore cost nothing.
+    '''
+
+    log = logging.getLogger("pylxcfs.refresh")
+
+    def __init__(self, cache, lead=2, idle=30):
+        self.cache = cache
+        self.lead = lead
+        self.idle = idle
+        self.enabled = False
+        self.__views = {}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def touch(self, render, key):
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self.__lock:
+            view = self.__views.get((render, key))
+            if view is None:
+                self.__views[(render, key)] = [now, now + self.__period()]
+            else:
+                view[0] = now
+
+    def __period(self):
+        return max(self.cache.ttl - self.lead, 1)
+
+    def start(self):
+        if not self.enabled or self.__thread is not None:
+            return
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="pylxcfs-refresh")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __due(self, now):
+        due = []
+        with self.__lock:
+            for (render, key), view in self.__views.items():
+                last_read, next_refresh = view
+                if now - last_read > self.idle:
+                    del self.__views[(render, key)]
+                elif next_refresh <= now:
+                    view[1] = now + self.__period()
+                    due.append((render, key))
+
+        # Host snapshots first, the views of the same tick render from them.
+        due.sort(key=lambda view: view[1] is not None)
+        return due
+
+    def __run(self):
+        while True:
+            time.sleep(1)
+            for render, key in self.__due(time.time()):
+                try:
+                    render(key)
+                except Exception:
+                    self.log.exception("refreshing %s(%r) failed",
+                                       render.__name__, key)
+                    with self.__lock:
+                        self.__views.pop((render, key), None)
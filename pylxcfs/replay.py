@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+"""
+    Replays a trace recorded with pylxcfs --trace into an in-process
+    LXCFuse and reports throughput and latency percentiles per operation:
+
+        python -m pylxcfs.replay TRACE [--speed 1] [--cpus 64 | --host]
+
+    By default the recorded cgroups are recreated on a synthetic host (see
+    pylxcfs.bench) with --cpus CPUs; --host serves the live host instead,
+    calling as a task of each recorded cgroup that still exists there.
+    Operations are issued at the recorded pace divided by --speed, or back
+    to back with --speed 0, from a single thread.
+"""
+
+import argparse
+import collections
+import shutil
+import sys
+import tempfile
+import time
+
+import pylxcfs.bench as bench
+import pylxcfs.fuse as fuse
+import pylxcfs.lxcfs as lxcfs
+from pylxcfs.trace import read_trace
+
+
+def live_pid(cgroup, pid):
+    """
+        Returns a task of a cpuset cgroup on this host, preferring the
+        recorded pid, or None if the cgroup is gone or empty.
+    """
+
+    try:
+        if lxcfs.get_cgroup(pid, "cpuset") == cgroup:
+            return pid
+    except (IOError, OSError):
+        pass
+
+    try:
+        procs = lxcfs.get_cgroup_value(lxcfs.controllers.get("cpuset"),
+                                       cgroup, "cgroup.procs").split()
+    except (IOError, OSError):
+        return None
+    return int(procs[0]) if procs else None
+
+
+def arguments(op, path, fh, size, offset, handles):
+    """
+        Returns the arguments LXCFuse expects for a recorded operation, or
+        None if the trace doesn't hold enough to replay it.
+    """
+
+    if op == "getattr":
+        return (path, None)
+    elif op == "readdir":
+        return (path, 0)
+    elif op == "open":
+        fi = handles[fh] = fuse.fuse_file_info()
+        return (path, fi)
+    elif op == "read":
+        # a handle opened before the recording started
+        return (path, size, offset,
+                handles.get(fh) or fuse.fuse_file_info())
+    elif op == "release":
+        return (path, handles.pop(fh, None) or fuse.fuse_file_info())
+    elif op in ("opendir", "statfs"):
+        return (path,)
+    elif op in ("releasedir", "access"):
+        # the mode of access() isn't recorded, it is never checked anyway
+        return (path, 0)
+    return None
+
+
+def percentile(latencies, q):
+    return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+
+def replay(trace, speed, operations, pids):
+    """
+        Issues the operations of the trace and returns (wall time, maximal
+        lag behind the recorded pace, {op: [(latency, recorded latency,
+        failed)]}).
+    """
+
+    caller = [0]
+    context = fuse.fuse_get_context
+    fuse.fuse_get_context = lambda: (0, 0, caller[0])
+
+    results = collections.defaultdict(list)
+    handles = {}
+    lag = 0
+    began = first = None
+    try:
+        for (start, op, path, cgroup, pid, fh, size, offset,
+             recorded) in trace:
+            args = arguments(op, path, fh, size, offset, handles)
+            if args is None:
+                results[op].append((None, recorded, False))
+                continue
+
+            now = time.time()
+            if began is None:
+                began, first = now, start
+            elif speed:
+                delay = began + (start - first) / speed - now
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+
+            caller[0] = pids.get(cgroup, 0)
+            failed = False
+            issued = time.time()
+            try:
+                operations(op, *args)
+            except OSError:
+                failed = True
+            results[op].append((time.time() - issued, recorded, failed))
+    finally:
+        fuse.fuse_get_context = context
+
+    return (time.time() - began if began else 0), lag, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="replay a pylxcfs operation trace")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay this many times faster than recorded, "
+                             "0 for back to back")
+    parser.add_argument("--cpus", type=int, default=64,
+                        help="CPUs of the synthetic host")
+    parser.add_argument("--host", action="store_true",
+                        help="replay against the live host")
+    args = parser.parse_args()
+
+    trace = list(read_trace(args.trace))
+    cgroups = {}
+    for start, op, path, cgroup, pid, fh, size, offset, recorded in trace:
+        if cgroup is not None:
+            cgroups.setdefault(cgroup, pid)
+
+    root = None
+    try:
+        if args.host:
+            operations = lxcfs.LXCFuse()
+            pids = {}
+            for cgroup, pid in cgroups.items():
+                pid = live_pid(cgroup, pid)
+                if pid is None:
+                    print >> sys.stderr, "%s: not on this host, its " \
+                        "operations will fail" % cgroup
+                else:
+                    pids[cgroup] = pid
+        else:
+            root = tempfile.mkdtemp(prefix="pylxcfs-replay-")
+            names = sorted(cgroups)
+            pids = dict(zip(names, bench.make_host(root, args.cpus,
+                                                   len(names), 1, names)))
+            operations = lxcfs.LXCFuse(root=root)
+
+        elapsed, lag, results = replay(trace, args.speed, operations, pids)
+    finally:
+        if root is not None:
+            lxcfs.setup()
+            shutil.rmtree(root)
+
+    total = sum(len(ops) for ops in results.values())
+    print "%d operations of %d cgroups in %.2fs, %.0f ops/s, " \
+          "at most %.3fs behind" % (total, len(cgroups), elapsed,
+                                    total / elapsed if elapsed else 0, lag)
+    print "%-10s %8s %7s %7s %10s %10s %10s %12s %12s" % (
+        "op", "count", "failed", "skipped", "p50_us", "p99_us", "max_us",
+        "rec_p50_us", "rec_p99_us")
+    for op, ops in sorted(results.items()):
+        latencies = sorted(l for l, r, failed in ops if l is not None)
+        recorded = sorted(r for l, r, failed in ops)
+        row = [op, len(ops), sum(1 for l, r, failed in ops if failed),
+               sum(1 for l, r, failed in ops if l is None)]
+        if latencies:
+            row += [percentile(latencies, 0.5) * 1e6,
+                    percentile(latencies, 0.99) * 1e6, latencies[-1] * 1e6]
+        else:
+            row += [0, 0, 0]
+        row += [percentile(recorded, 0.5) * 1e6,
+                percentile(recorded, 0.99) * 1e6]
+        print "%-10s %8d %7d %7d %10.0f %10.0f %10.0f %12.0f %12.0f" % \
+            tuple(row)
+
+
+if __name__ == "__main__":
+    main()
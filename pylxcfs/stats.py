@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import logging
+import os
+import threading
+
+
+# Upper bounds of the latency buckets, in seconds.
+BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+          0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float("inf"))
+
+# family -> (label name, help text)
+FAMILIES = collections.OrderedDict([
+    ("op", ("op", "FUSE operations handled")),
+    ("file", ("path", "open() of a virtual file, rendering included")),
+    ("cgroup", ("cgroup", "open() of a virtual file by callers in a cgroup")),
+    ("render", ("entry", "cache misses rendered, by cache entry")),
+])
+
+
+class Histogram(object):
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BOUNDS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(BOUNDS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q):
+        """
+            Returns the upper bound of the bucket holding the q quantile.
+        """
+
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BOUNDS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return BOUNDS[-1]
+
+
+class Stats:
+    '''
+    Request counters and latency histograms per FUSE operation, virtual
+    file, caller cgroup and rendered cache entry, plus the counters of the
+    ProcCache. Only the `max_cgroups` most recently seen cgroups are kept.
+    '''
+
+    def __init__(self, cache, max_cgroups=4096):
+        self.cache = cache
+        self.max_cgroups = max_cgroups
+        self.__lock = threading.Lock()
+        self.__families = dict((family, collections.OrderedDict())
+                               for family in FAMILIES)
+
+    def observe(self, family, name, seconds):
+        with self.__lock:
+            histograms = self.__families[family]
+            histogram = histograms.pop(name, None)
+            if histogram is None:
+                histogram = Histogram()
+            histograms[name] = histogram
+            histogram.observe(seconds)
+
+            if family == "cgroup" and len(histograms) > self.max_cgroups:
+                histograms.popitem(last=False)
+
+    def __snapshot(self):
+        with self.__lock:
+            return [(family, [(name, h.count, h.total, h.max, h.quantile(0.5),
+                               h.quantile(0.99), list(h.buckets))
+                              for name, h in self.__families[family].items()])
+                    for family in FAMILIES]
+
+    def __counters(self):
+        return [("cache_entries", len(self.cache)),
+                ("cache_bytes", self.cache.nbytes),
+                ("cache_hits", self.cache.hits),
+                ("cache_misses", self.cache.misses),
+                ("cache_coalesced", self.cache.coalesced),
+                ("cache_expirations", self.cache.expirations),
+                ("cache_evictions", self.cache.evictions)]
+
+    def render(self):
+        """
+            Returns the statistics as plain text, latencies in microseconds.
+        """
+
+        output = "".join("%s %s\n" % (name, value)
+                         for name, value in self.__counters())
+
+        output += "\n%-8s %-40s %10s %10s %10s %10s %10s\n" % (
+            "family", "name", "count", "avg_us", "max_us", "p50_us", "p99_us")
+        for family, histograms in self.__snapshot():
+            for name, count, total, top, p50, p99, buckets in histograms:
+                output += "%-8s %-40s %10d %10d %10d %10s %10s\n" % (
+                    family, name, count, total / count * 1e6, top * 1e6,
+                    _us(p50), _us(p99))
+        return output
+
+    def prometheus(self):
+        """
+            Returns the statistics in the Prometheus text exposition format.
+        """
+
+        output = ""
+        for name, value in self.__counters():
+            kind = "gauge" if name in ("cache_entries", "cache_bytes") \
+                   else "counter"
+            if kind == "counter":
+                name += "_total"
+            output += "# TYPE pylxcfs_%s %s\npylxcfs_%s %d\n" % (
+                name, kind, name, value)
+
+        for family, histograms in self.__snapshot():
+            label, text = FAMILIES[family]
+            metric = "pylxcfs_%s_seconds" % family
+            output += "# HELP %s %s\n# TYPE %s histogram\n" % (metric, text,
+                                                               metric)
+            for name, count, total, top, p50, p99, buckets in histograms:
+                name = _escape(name)
+                cumulative = 0
+                for bound, n in zip(BOUNDS, buckets):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    output += '%s_bucket{%s="%s",le="%s"} %d\n' % (
+                        metric, label, name, le, cumulative)
+                output += '%s_sum{%s="%s"} %r\n' % (metric, label, name, total)
+                output += '%s_count{%s="%s"} %d\n' % (metric, label, name,
+                                                      count)
+        return output
+
+    def serve(self, path):
+        """
+            Serves prometheus() over HTTP on a unix socket, from a daemon
+            thread.
+        """
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        stats = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.prometheus()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return path
+
+            def log_message(self, format, *args):
+                logging.getLogger("pylxcfs.stats").debug(format, *args)
+
+        server = SocketServer.UnixStreamServer(path, Handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="pylxcfs-stats")
+        thread.daemon = True
+        thread.start()
+
+
+def _us(seconds):
+    if seconds == float("inf"):
+        return "inf"
+    return "<=%d" % (seconds * 1e6)
+
+
+def _escape(name):
+    return str(name).replace("\\", "\\\\").replace('"', '\\"')
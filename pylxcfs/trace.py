@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+import struct
+import threading
+import time
+
+
+# A trace is a sequence of records, each starting with a one byte tag:
+#   SESSION  magic and version; starts every recording appended to the file
+#   NAME     id, length and bytes of an op name, path or cgroup; ids are
+#            only valid up to the next SESSION
+#   OP       one handled operation, names given by id
+SESSION, NAME, OP = "S", "N", "O"
+
+MAGIC = "PLXT"
+VERSION = 1
+
+_session = struct.Struct("<c4sB")
+_name = struct.Struct("<cIH")
+# tag, timestamp, op, path, cgroup, pid, fh, size, offset, latency
+_op = struct.Struct("<cdIIIIIIqf")
+
+
+class TraceRecorder:
+    '''
+    Appends every handled FUSE operation to a compact binary trace: when it
+    started, how long it took, op, path, size and offset of reads, the file
+    handle and the caller pid and cgroup. Names are written once and then
+    referenced by id, so a record is a fixed 45 bytes.
+
+    Records are buffered and flushed at least every `flush_interval`
+    seconds; a crash loses at most that much of the trace.
+    '''
+
+    def __init__(self, flush_interval=1):
+        self.flush_interval = flush_interval
+        self.enabled = False
+        self.__fd = None
+        self.__ids = {}
+        self.__flushed = 0
+        self.__lock = threading.Lock()
+
+    def open(self, path):
+        with self.__lock:
+            self.__fd = open(path, "ab", 64 * 1024)
+            self.__fd.write(_session.pack(SESSION, MAGIC, VERSION))
+            self.__ids = {}
+            self.__flushed = time.time()
+            self.enabled = True
+
+    def close(self):
+        with self.__lock:
+            self.enabled = False
+            if self.__fd is not None:
+                self.__fd.close()
+                self.__fd = None
+
+    def __id(self, name):
+        if name is None:
+            name = ""
+        elif isinstance(name, unicode):
+            name = name.encode("utf-8")
+
+        i = self.__ids.get(name)
+        if i is None:
+            i = self.__ids[name] = len(self.__ids)
+            self.__fd.write(_name.pack(NAME, i, len(name)))
+            self.__fd.write(name)
+        return i
+
+    def record(self, start, op, path, cgroup, pid, fh, size, offset,
+               latency):
+        with self.__lock:
+            if self.__fd is None:
+                return
+            self.__fd.write(_op.pack(OP, start, self.__id(op),
+                                     self.__id(path), self.__id(cgroup),
+                                     pid, fh, size, offset, latency))
+            if start - self.__flushed >= self.flush_interval:
+                self.__fd.flush()
+                self.__flushed = start
+
+
+class TraceError(Exception):
+    pass
+
+
+def read_trace(path):
+    """
+        Yields the recorded operations of a trace as tuples of (start, op,
+        path, cgroup, pid, fh, size, offset, latency); cgroup is None if the
+        caller was unknown. A record cut short by a crash ends the trace.
+    """
+
+    with open(path, "rb") as fd:
+        data = fd.read()
+
+    names = None
+    offset = 0
+    while offset < len(data):
+        tag = data[offset]
+        try:
+            if tag == SESSION:
+                tag, magic, version = _session.unpack_from(data, offset)
+                if magic != MAGIC or version != VERSION:
+                    raise TraceError("%s: unsupported trace" % path)
+                offset += _session.size
+                names = {}
+            elif names is None:
+                raise TraceError("%s: not a trace" % path)
+            elif tag == NAME:
+                tag, i, length = _name.unpack_from(data, offset)
+                offset += _name.size
+                if offset + length > len(data):
+                    return
+                names[i] = data[offset:offset + length] or None
+                offset += length
+            elif tag == OP:
+                (tag, start, op, name, cgroup, pid, fh, size, position,
+                 latency) = _op.unpack_from(data, offset)
+                offset += _op.size
+                yield (start, names[op], names[name], names[cgroup], pid, fh,
+                       size, position, latency)
+            else:
+                raise TraceError("%s: corrupt record at %d" % (path, offset))
+        except struct.error:
+            return
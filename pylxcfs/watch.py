@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import logging
+
+
+IN_MODIFY = 0x00000002
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+class CgroupWatcher:
+    '''
+    Event driven invalidation of cached cgroup values. A cached value that
+    was read from a cgroup file registers the file with watch() and is
+    dropped from the cache as soon as the file is written to (IN_MODIFY),
+    so it can be cached far longer than the regular cache ttl. Writes to
+    cgroup control files go through the VFS like any other write, which
+    makes inotify fire for them.
+
+    cgroupfs never reports IN_DELETE_SELF for a removed cgroup, so removal
+    is caught with an IN_DELETE watch on the parent directory instead; it
+    drops every value registered for the cgroup and releases the watches
+    on its files, which would otherwise pin the dead inodes. If the event
+    queue overflows, every watched value is dropped.
+
+    If inotify isn't available or a watch can't be added, e.g. once
+    max_user_watches is used up, watch() returns False and callers fall
+    back to ttl based expiry. Watched values are still given a long backstop
+    ttl, so a write racing with the initial read can't pin a stale value.
+    '''
+
+    log = logging.getLogger("pylxcfs.watch")
+    ttl = 300
+
+    def __init__(self, invalidate):
+        self.__invalidate = invalidate
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__wake = None
+        # wd -> cache keys dropped when the watched file is modified
+        self.__watches = {}
+        # cgroup directory -> (file wds, cache keys dropped on removal)
+        self.__cgroups = {}
+        # (parent wd, name) -> cgroup directory
+        self.__children = {}
+        self.__fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self.__fd < 0:
+            self.log.warning("inotify unavailable: %s",
+                             os.strerror(ctypes.get_errno()))
+
+    def watch(self, c_path, cgroup, key, entry):
+        """
+            Drops (cgroup, entry) from the cache once the cgroup file key is
+            written to or the cgroup is removed; with key None only removal
+            is watched. Returns whether the watch is in place.
+        """
+
+        if self.__fd < 0 or self.__thread is None:
+            return False
+
+        path = os.path.normpath("%s/%s" % (c_path, cgroup))
+        parent, name = os.path.split(path)
+
+        with self.__lock:
+            if path not in self.__cgroups:
+                # the root cgroup can't be removed
+                if cgroup.strip("/"):
+                    wd = _libc.inotify_add_watch(self.__fd, parent, IN_DELETE)
+                    if wd < 0:
+                        # e.g. out of watches (ENOSPC), try again next time
+                        return False
+                    self.__children[(wd, name)] = path
+                self.__cgroups[path] = (set(), set())
+            wds, keys = self.__cgroups[path]
+
+            if key is not None:
+                wd = _libc.inotify_add_watch(self.__fd,
+                                             "%s/%s" % (path, key),
+                                             IN_MODIFY)
+                if wd < 0:
+                    return False
+                wds.add(wd)
+                self.__watches.setdefault(wd, set()).add((cgroup, entry))
+
+            keys.add((cgroup, entry))
+        return True
+
+    def start(self):
+        if self.__fd < 0 or self.__thread is not None:
+            return
+
+        # written to by close() to stop the thread
+        self.__wake = os.pipe()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="pylxcfs-watch")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def close(self):
+        """
+            Stops watching and releases the inotify descriptor; watch()
+            returns False from now on.
+        """
+
+        thread = self.__thread
+        if thread is not None:
+            # The thread must be gone before the descriptor number can be
+            # reused.
+            os.write(self.__wake[1], "\0")
+            thread.join()
+            os.close(self.__wake[0])
+            os.close(self.__wake[1])
+
+        with self.__lock:
+            self.__thread = None
+            if self.__fd >= 0:
+                os.close(self.__fd)
+                self.__fd = -1
+            self.__watches.clear()
+            self.__cgroups.clear()
+            self.__children.clear()
+
+    def __removed(self, wd, name):
+        path = self.__children.pop((wd, name), None)
+        if path is None:
+            return ()
+
+        wds, keys = self.__cgroups.pop(path)
+        for wd in wds:
+            self.__watches.pop(wd, None)
+            _libc.inotify_rm_watch(self.__fd, wd)
+        return keys
+
+    def __overflowed(self):
+        # Events were lost, any watched value may be stale: drop them all,
+        # they are registered again when read.
+        self.log.warning("inotify queue overflow, dropping every watched "
+                         "value")
+        keys = set()
+        for wd in self.__watches:
+            keys |= self.__watches[wd]
+            self.__watches[wd] = set()
+        for wds, removal in self.__cgroups.values():
+            keys |= removal
+            removal.clear()
+        return keys
+
+    def __run(self):
+        poller = select.poll()
+        poller.register(self.__fd, select.POLLIN)
+        poller.register(self.__wake[0], select.POLLIN)
+        while True:
+            try:
+                ready = dict(poller.poll())
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.__wake[0] in ready:
+                return
+
+            buf = os.read(self.__fd, 64 * 1024)
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = _event.unpack_from(buf, offset)
+                name = buf[offset + _event.size:
+                           offset + _event.size + length].rstrip("\0")
+                offset += _event.size + length
+
+                with self.__lock:
+                    if mask & IN_Q_OVERFLOW:
+                        keys = self.__overflowed()
+                    elif mask & IN_DELETE:
+                        keys = self.__removed(wd, name)
+                    elif mask & IN_IGNORED:
+                        keys = self.__watches.pop(wd, ())
+                    elif mask & IN_MODIFY:
+                        # The watch stays, but the values have to be read
+                        # (and registered) again.
+                        keys = self.__watches.get(wd, set())
+                        self.__watches[wd] = set()
+                    else:
+                        keys = ()
+
+                for cgroup, entry in keys:
+                    self.__invalidate(cgroup, entry)